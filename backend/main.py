@@ -1,178 +1,1685 @@
 import json
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 import base64
 from datetime import datetime
 import os
-from google import genai
-from google.genai import types
+import importlib
 import pathlib
+import argparse
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import re
 import csv
 import time
+import logging
+import random
+import sys
+import gzip
+import io
+import zlib
+import urllib.parse
+import hashlib
+import uuid
+import math
+import threading
+import subprocess
+from collections import deque, OrderedDict
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class LazyModule:
+    # google.genai pulls in pydantic, httpx and google-auth, so it is only imported by the AI commands
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            logger.info("Importing %s", self._name)
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+genai = LazyModule('google.genai')
+types = LazyModule('google.genai.types')
+
+BATCH_MAX_COMMANDS = int(os.environ.get('BATCH_MAX_COMMANDS', '25'))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', '8'))
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_FIELD_CHARS = int(os.environ.get('LOG_MAX_FIELD_CHARS', '500'))
+LOG_MAX_ITEMS = int(os.environ.get('LOG_MAX_ITEMS', '3'))
+# Fraction of invocations logged at DEBUG, per command, e.g. "get_flashcards=0.01,*=0.1"
+LOG_DEBUG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, rate in (entry.split('=', 1) for entry in os.environ.get('LOG_DEBUG_SAMPLE_RATES', '').split(',') if '=' in entry)
+}
+
+# Responses smaller than this are returned uncompressed
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', '4096'))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', '5'))
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+    'Access-Control-Allow-Headers': 'Content-Type,If-None-Match',
+    'Access-Control-Expose-Headers': 'ETag,Retry-After'
+}
+
+# The load balancer gives up on the client after about 29 s, even though the function may run longer
+REQUEST_TIMEOUT_MS = int(os.environ.get('REQUEST_TIMEOUT_MS', '28000'))
+# Time kept back from every budget to build and return the response
+DEADLINE_SAFETY_MS = int(os.environ.get('DEADLINE_SAFETY_MS', '1000'))
+AWS_CONNECT_TIMEOUT_S = float(os.environ.get('AWS_CONNECT_TIMEOUT_S', '2'))
+AWS_MAX_READ_TIMEOUT_S = float(os.environ.get('AWS_MAX_READ_TIMEOUT_S', '60'))
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', '25'))
+AWS_TCP_KEEPALIVE = os.environ.get('AWS_TCP_KEEPALIVE', 'true').lower() == 'true'
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'standard')
+# Read timeouts are rounded down to one of these, so warm containers reuse a handful of clients
+AWS_TIMEOUT_BUCKETS_S = (0.5, 1, 2, 5, 10, 20, 30, 60)
+# Comma separated subset of 'aws' and 'gemini' to warm up during the Lambda init phase
+PRIME_ON_INIT = [target.strip() for target in os.environ.get('PRIME_ON_INIT', '').split(',') if target.strip()]
+GEMINI_APIKEY_TTL_S = int(os.environ.get('GEMINI_APIKEY_TTL_S', '3600'))
+# S3 multipart parts must be at least 5 MiB, except the last one
+EXPORT_PART_SIZE = max(5 * 1024 * 1024, int(os.environ.get('EXPORT_PART_SIZE', str(8 * 1024 * 1024))))
+GET_FLASHCARDS_MAX_PAGE_SIZE = int(os.environ.get('GET_FLASHCARDS_MAX_PAGE_SIZE', '500'))
+FLASHCARD_FIELDS = ('set', 'id', 'question', 'answer', 'updated_at')
+GET_SETS_DEFAULT_PAGE_SIZE = int(os.environ.get('GET_SETS_DEFAULT_PAGE_SIZE', '50'))
+GET_SETS_MAX_PAGE_SIZE = int(os.environ.get('GET_SETS_MAX_PAGE_SIZE', '200'))
+SET_KIND = 'set'
+# Global secondary indexes on the sets table, all partitioned by the constant 'kind' attribute
+SETS_SORT_INDEXES = {
+    'created_at': os.environ.get('SETS_CREATED_INDEX', 'kind-created_at-index'),
+    'name': os.environ.get('SETS_NAME_INDEX', 'kind-name-index'),
+    'last_modified': os.environ.get('SETS_MODIFIED_INDEX', 'kind-last_modified-index'),
+}
+PURGE_MAX_WORKERS = int(os.environ.get('PURGE_MAX_WORKERS', '8'))
+# Card ids deleted between progress updates and deadline checks
+PURGE_PAGE_SIZE = int(os.environ.get('PURGE_PAGE_SIZE', '1000'))
+PURGE_RESERVE_MS = int(os.environ.get('PURGE_RESERVE_MS', '10000'))
+ID_EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+ID_WORKER_BITS = 7
+ID_SEQUENCE_BITS = 5
+ID_TIMESTAMP_SHIFT = ID_WORKER_BITS + ID_SEQUENCE_BITS
+# Random per container unless pinned
+ID_WORKER_ID = int(os.environ['ID_WORKER_ID']) % (1 << ID_WORKER_BITS) if os.environ.get('ID_WORKER_ID') else None
+# Conditional puts of single cards retry this often with a new id when the id is taken
+ID_PUT_ATTEMPTS = 3
+READ_CACHE_TTL_S = int(os.environ.get('READ_CACHE_TTL_S', '300'))
+READ_CACHE_MAX_BYTES = int(os.environ.get('READ_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# Answers above this size are stored compressed as binary, 'zlib' or 'zstd' (needs the zstandard package)
+ANSWER_COMPRESS_MIN_BYTES = int(os.environ.get('ANSWER_COMPRESS_MIN_BYTES', '1024'))
+ANSWER_CODEC = os.environ.get('ANSWER_CODEC', 'zlib')
+ANSWER_ZLIB_LEVEL = int(os.environ.get('ANSWER_ZLIB_LEVEL', '6'))
+# Cards still bigger than this after compression keep their answer in S3, DynamoDB items are limited to 400 KB
+ANSWER_OFFLOAD_BYTES = int(os.environ.get('ANSWER_OFFLOAD_BYTES', str(350 * 1024)))
+ANSWER_BUCKET = os.environ.get('ANSWER_BUCKET', 'flashcards-ai')
+ANSWER_STORAGE_ATTRIBUTES = ('answer', 'answer_codec', 'answer_ref', 'answer_size')
+BACKUP_BUCKET = os.environ.get('BACKUP_BUCKET', 'flashcards-ai')
+BACKUP_PREFIX = 'backups/'
+BACKUP_SEGMENTS = int(os.environ.get('BACKUP_SEGMENTS', '8'))
+BACKUP_MAX_SEGMENTS = 64
+BACKUP_MAX_WORKERS = int(os.environ.get('BACKUP_MAX_WORKERS', '16'))
+CLI_DEADLINE_MS = 24 * 3600 * 1000
+# Extra shard attribute carrying an offloaded answer's S3 object
+BACKUP_ANSWER_OBJECT = '__answer_object'
+# BatchWriteItem takes at most 25 requests
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_MAX_ATTEMPTS = int(os.environ.get('BATCH_WRITE_MAX_ATTEMPTS', '8'))
+BATCH_WRITE_BASE_BACKOFF_MS = int(os.environ.get('BATCH_WRITE_BASE_BACKOFF_MS', '50'))
+BATCH_WRITE_MAX_BACKOFF_MS = int(os.environ.get('BATCH_WRITE_MAX_BACKOFF_MS', '2000'))
+# Time needed to safely start one more DynamoDB write in a loop
+WRITE_BUDGET_MS = int(os.environ.get('WRITE_BUDGET_MS', '1000'))
+# Time reserved after a Gemini call to persist its results
+GEMINI_RESERVE_MS = int(os.environ.get('GEMINI_RESERVE_MS', '3000'))
+GEMINI_MIN_TIMEOUT_MS = int(os.environ.get('GEMINI_MIN_TIMEOUT_MS', '5000'))
+# Generating cards from a file runs in a background invocation unless this much time is left
+FILE_GENERATION_BUDGET_MS = int(os.environ.get('FILE_GENERATION_BUDGET_MS', '60000'))
+
+# Responses above this size are written to S3 and replaced by a presigned URL.
+# Lambda allows 6 MB for synchronous responses, an ALB target only 1 MB.
+RESPONSE_SPILL_BYTES = int(os.environ.get('RESPONSE_SPILL_BYTES', '900000'))
+RESPONSE_SPILL_BUCKET = os.environ.get('RESPONSE_SPILL_BUCKET', 'flashcards-ai')
+RESPONSE_SPILL_URL_TTL = int(os.environ.get('RESPONSE_SPILL_URL_TTL', '300'))
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+IDEMPOTENCY_TABLE = os.environ.get('IDEMPOTENCY_TABLE', 'flashcards-idempotency')
+# How long a stored result is replayed, enforced by a DynamoDB TTL on expires_at
+IDEMPOTENCY_TTL_S = int(os.environ.get('IDEMPOTENCY_TTL_S', '86400'))
+# After this long an unfinished execution is considered dead and may be retried
+IDEMPOTENCY_LOCK_S = int(os.environ.get('IDEMPOTENCY_LOCK_S', '900'))
+
+RATE_LIMIT_TABLE = os.environ.get('RATE_LIMIT_TABLE', 'flashcards-ratelimit')
+# Token buckets per caller and command tier as "tier=tokens_per_second:burst"
+RATE_LIMITS = {
+    tier.strip(): tuple(float(value) for value in limits.split(':'))
+    for tier, limits in (entry.split('=', 1) for entry in os.environ.get('RATE_LIMITS', 'read=10:100,write=2:30,ai=0.05:3').split(',') if '=' in entry)
+}
+# Tokens a container takes from the shared bucket at once as "tier=tokens", spent locally until the lease expires
+RATE_LEASES = {
+    tier.strip(): float(size)
+    for tier, size in (entry.split('=', 1) for entry in os.environ.get('RATE_LEASES', 'read=5').split(',') if '=' in entry)
+}
+RATE_LEASE_MS = int(os.environ.get('RATE_LEASE_MS', '1000'))
+
+# A dependency's circuit opens when at least CIRCUIT_FAILURE_RATE of the calls in the last
+# CIRCUIT_WINDOW_S seconds failed, and is probed again after CIRCUIT_OPEN_S seconds
+CIRCUIT_FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', '0.5'))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', '5'))
+CIRCUIT_WINDOW_S = float(os.environ.get('CIRCUIT_WINDOW_S', '60'))
+CIRCUIT_OPEN_S = float(os.environ.get('CIRCUIT_OPEN_S', '30'))
+
+# Global secondary index on flashcards with hash key 'set' and range key 'updated_at'
+FLASHCARDS_UPDATED_INDEX = os.environ.get('FLASHCARDS_UPDATED_INDEX', 'set-updated_at-index')
+# Deleted cards, hash key 'set' and range key 'id', expired through a TTL on expires_at
+TOMBSTONE_TABLE = os.environ.get('TOMBSTONE_TABLE', 'flashcards-tombstones')
+TOMBSTONE_TTL_S = int(os.environ.get('TOMBSTONE_TTL_S', str(30 * 86400)))
+# Writes are timestamped by the container clock, so each sync looks back this far to catch late commits
+SYNC_CLOCK_SKEW_MS = int(os.environ.get('SYNC_CLOCK_SKEW_MS', '2000'))
+
+BUNDLE_CACHE_CONTROL = os.environ.get('BUNDLE_CACHE_CONTROL', 'private, max-age=60')
+
+# Item in the sets table whose version is bumped on every write, used as the get_sets ETag
+SETS_VERSION_KEY = os.environ.get('SETS_VERSION_KEY', '#sets')
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    def __init__(self, budget_ms):
+        self.expires_at = time.monotonic() + budget_ms / 1000.0
+
+    @classmethod
+    def from_context(cls, context, limit_ms=None):
+        budget_ms = context.get_remaining_time_in_millis() if context is not None else (limit_ms or REQUEST_TIMEOUT_MS)
+        if limit_ms is not None:
+            budget_ms = min(budget_ms, limit_ms)
+        return cls(budget_ms - DEADLINE_SAFETY_MS)
+
+    def remaining_ms(self):
+        return max(0, int((self.expires_at - time.monotonic()) * 1000))
+
+    def has(self, needed_ms):
+        return self.remaining_ms() >= needed_ms
+
+    def check(self, needed_ms=0, what="request"):
+        if not self.has(max(needed_ms, 1)):
+            raise DeadlineExceeded(f"Not enough time left to complete {what} ({self.remaining_ms()} ms remaining)")
+
+    def timeout(self, cap_s):
+        self.check()
+        return min(cap_s, self.remaining_ms() / 1000.0)
+
+# Deadline of the current invocation, shared with batch worker threads
+_deadline = Deadline(REQUEST_TIMEOUT_MS)
+_function_name = None
+# Caller of the current request, idempotency keys are only unique per caller
+_caller = None
+# Idempotency record of the request running in this thread, batch commands run in worker threads
+_idempotency = threading.local()
+
+# Commands that can be handed off to an asynchronous invocation of this function
+BACKGROUND_COMMANDS = {}
+
+def background(handler):
+    BACKGROUND_COMMANDS[handler.__name__] = handler
+    return handler
+
+class CommandInProgress(Exception):
+    pass
+
+class IdempotencyKeyReused(Exception):
+    pass
+
+class CircuitOpen(Exception):
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is currently unavailable, retry in {retry_after} s")
+        self.retry_after = retry_after
+
+def is_dependency_failure(error):
+    if isinstance(error, ClientError):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500)
+        return status >= 500 or status == 429 or 'Throttl' in error.response.get('Error', {}).get('Code', '')
+    # google-genai API errors carry the HTTP status as 'code'
+    code = getattr(error, 'code', None)
+    if isinstance(code, int) and 400 <= code < 500 and code != 429:
+        return False
+    return True
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.calls = deque()
+        self.opened_at = 0.0
+        self.probing = False
+
+    def before_call(self):
+        with self.lock:
+            if self.state == 'closed':
+                return
+            retry_after = self.opened_at + CIRCUIT_OPEN_S - time.monotonic()
+            if retry_after > 0 or self.probing:
+                raise CircuitOpen(self.name, max(1, math.ceil(retry_after)))
+            # Half-open: let a single probe through
+            self.state = 'half_open'
+            self.probing = True
+
+    def record(self, ok):
+        now = time.monotonic()
+        with self.lock:
+            if self.state == 'half_open':
+                self.probing = False
+                self.calls.clear()
+                self.state = 'closed' if ok else 'open'
+                self.opened_at = now
+                logger.warning("Circuit %s probe %s, circuit is %s", self.name, 'succeeded' if ok else 'failed', self.state)
+                return
+            self.calls.append((now, ok))
+            while self.calls and self.calls[0][0] < now - CIRCUIT_WINDOW_S:
+                self.calls.popleft()
+            failures = sum(1 for _, call_ok in self.calls if not call_ok)
+            if self.state == 'closed' and len(self.calls) >= CIRCUIT_MIN_CALLS and failures >= CIRCUIT_FAILURE_RATE * len(self.calls):
+                self.state = 'open'
+                self.opened_at = now
+                logger.error("Circuit %s opened after %d failures in %d calls", self.name, failures, len(self.calls))
+
+    def call(self, fn, *args, **kwargs):
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self.record(not is_dependency_failure(e))
+            raise
+        self.record(True)
+        return result
+
+CIRCUITS = {name: CircuitBreaker(name) for name in ('gemini', 's3', 'secretsmanager')}
+
+class RateLimited(Exception):
+    def __init__(self, tier, retry_after):
+        super().__init__(f"Rate limit exceeded for {tier} commands, retry in {retry_after} s")
+        self.retry_after = retry_after
+
+class NotModified(Exception):
+    def __init__(self, etag):
+        super().__init__(f"Not modified: {etag}")
+        self.etag = etag
+
+# Fields added to every log line of the current invocation
+_log_context = {}
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'level': record.levelname, 'message': record.getMessage()}
+        entry.update(_log_context)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class Truncated:
+    # Renders a log argument only when the line is actually emitted, and caps its size
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit or LOG_MAX_FIELD_CHARS
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, (list, tuple)) and len(value) > LOG_MAX_ITEMS:
+            value = list(value[:LOG_MAX_ITEMS]) + [f'... {len(self.value) - LOG_MAX_ITEMS} more']
+        text = value if isinstance(value, str) else json.dumps(value, default=str)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}... [{len(text)} chars]"
+        return text
+
+logger = logging.getLogger('flashcards')
+logger.propagate = False
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(JsonLogFormatter())
+    logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
+
+def configure_invocation_logging(command, request_id=None):
+    _log_context.clear()
+    if command:
+        _log_context['command'] = command
+    if request_id:
+        _log_context['request_id'] = request_id
+    rate = LOG_DEBUG_SAMPLE_RATES.get(command, LOG_DEBUG_SAMPLE_RATES.get('*', 0.0))
+    sampled = rate > 0 and random.random() < rate
+    if sampled:
+        _log_context['sampled'] = True
+    logger.setLevel(logging.DEBUG if sampled else LOG_LEVEL)
+
+# Command name -> handler and argument schema, filled in by the @command decorator
+COMMANDS = {}
+
+def command(name=None, required=(), optional=None, mutates=False, etag=None, idempotent=None, rate=None, cache_control=None, stream=None, cache=False, columnar=False):
+    def register(handler):
+        COMMANDS[name or handler.__name__] = {
+            'handler': handler,
+            'required': tuple(required),
+            'optional': dict(optional or {}),
+            'mutates': mutates,
+            'etag': etag,
+            'idempotent': mutates if idempotent is None else idempotent,
+            'rate': rate or ('write' if mutates else 'read'),
+            'cache_control': cache_control,
+            'stream': stream,
+            'cache': cache,
+            'columnar': columnar,
+        }
+        return handler
+    return register
 
 def init_gemini_client():
-    set_gemini_apikey()
     global client
-    if client is None:
-        try:
+    try:
+        set_gemini_apikey()
+        if client is None:
             client = genai.Client(api_key=_gemini_apikey_cache)
-        except Exception as e:
-            print(f"Error initializing Gemini client: {e}")
-            client = None
+    except Exception as e:
+        logger.error("Error initializing Gemini client: %s", e)
+        client = None
+
+def require_gemini_client():
+    # Unlike init_gemini_client this surfaces why the client is unavailable, e.g. an open circuit
+    set_gemini_apikey()
+    init_gemini_client()
+    if client is None:
+        raise RuntimeError("Gemini client is not available")
+    return client
 
 
 
 
 def lambda_handler(event, context):
-    init_gemini_client()
-    print("Received event:")
-    print(f"{json.dumps(event)}")
+    global _deadline, _function_name, _caller
+    _function_name = getattr(context, 'function_name', None)
+    _caller = None
+    if 'background_command' in event:
+        _deadline = Deadline.from_context(context)
+        return run_background_command(event, context)
+    _deadline = Deadline.from_context(context, REQUEST_TIMEOUT_MS)
+    _caller = caller_id(event)
+    configure_invocation_logging(None, getattr(context, 'aws_request_id', None))
+    logger.info("Received %s request", event.get('httpMethod'))
+    logger.debug("Received event: %s", Truncated(event))
     if event['httpMethod'] == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
+            'headers': dict(CORS_HEADERS),
             'body': ''
         }
     
+    command = None
     try:
-        body = event['body']
-        if not body:
-            raise ValueError("Request body is empty")
-            
-        try:
-            decoded_body = base64.b64decode(body)
-        except Exception as e:
-            raise ValueError(f"Failed to decode base64 body: {str(e)}")
-            
-        try:
-            json_body = json.loads(decoded_body)
-        except json.JSONDecodeError as e:
-            raise ValueError(f"Failed to parse JSON body: {str(e)}")
+        json_body = decode_request_body(event)
             
-        if 'command' not in json_body:
+        if not isinstance(json_body, dict) or 'command' not in json_body:
             raise ValueError("Missing required 'command' field in request")
             
         command = json_body['command']
         content = json_body.get('content', "")
         
-        print(f"command: {command}")
-        print(f"content: {content}")
+        configure_invocation_logging(command, getattr(context, 'aws_request_id', None))
+        logger.info("Dispatching command %s", command)
+        logger.debug("content: %s", Truncated(content))
         
+        enforce_rate_limits(_caller, command, content)
 
-        command_result = command_dispatch(command, content)
-        
-        if command_result is False:
-            raise ValueError(f"Invalid command: {command}")
+        if is_streaming_request(command, event):
+            # Lambda buffers the whole body anyway, but cards are still encoded one at a time
+            response_body = ''.join(stream_command(command, content))
+            content_type = NDJSON_CONTENT_TYPE
+            headers = {'Content-Type': content_type}
+            status_code = 200
+            logger.info("Command %s streamed %d bytes", command, len(response_body))
+        else:
+            command_result = command_dispatch(command, content, request_header(event, 'If-None-Match'))
+                
+            response_body, content_type = encode_response_body(command_result, event)
+            logger.info("Command %s returned %d bytes of %s", command, len(response_body), content_type)
+            logger.debug("response_body: %s", Truncated(command_result))
             
-        response_body = json.dumps(command_result)
-        print(f"response_body: {response_body}")
-        
-        response = {
-            'statusCode': 200 if 'msg' in command_result else 400,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': response_body
-        }
+            headers = {'Content-Type': content_type}
+            if 'etag' in command_result:
+                headers['ETag'] = command_result['etag']
+            if 'msg' in command_result and COMMANDS[command]['cache_control']:
+                headers['Cache-Control'] = COMMANDS[command]['cache_control']
+            status_code = 200 if 'msg' in command_result else 400
+
+        response = build_response(status_code, response_body, event, headers)
+        if len(response['body']) > RESPONSE_SPILL_BYTES:
+            response = spill_response(status_code, response_body, content_type, event, headers)
         
-    except ValueError as e:
-        error_msg = str(e)
-        print(f"Validation error: {error_msg}")
-        response = {
-            'statusCode': 400,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST,GET', 
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': json.dumps({'error': error_msg})
-        }
     except Exception as e:
-        error_msg = f"Internal server error: {str(e)}"
-        print(f"Error: {error_msg}")
-        response = {
-            'statusCode': 500,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': json.dumps({'error': error_msg})
-        }
+        response = error_response(e, command, event)
     
     return response
 
-def command_dispatch(command, content):
-    if command == "create_set":
-        return create_set(content["name"], content["description"], content.get("filename", ""))
-    elif command == "get_sets":
-        return get_sets()
-    elif command == "add_flashcard":
-        return add_flashcard(content["set_name"], content["question"], content["answer"])
-    elif command == "update_flashcard":
-        return update_flashcard(content["set_name"], content["id"], content["question"], content["answer"])
-    elif command == "delete_flashcard":
-        return delete_flashcard(content["set_name"], content["id"])
-    elif command == "delete_set_with_flashcards":
-        return delete_set_with_flashcards(content["set_name"])
-    elif command == "get_flashcards":
-        return get_flashcards(content["set_name"])
-    elif command == "suggest_flashcard_answer":
-        return suggest_flashcard_answer(content["question"])
-    elif command == "suggest_flashcards":
-        return suggest_flashcards(content["set_name"])
-    elif command == "import_flashcards_from_csv":
-        return import_flashcards_from_csv(content["set_name"], content["filename"])
-    elif command == "export_flashcards_to_csv":
-        return export_flashcards_to_csv(content["set_name"])
-    else:
+def error_response(error, command, event):
+    if isinstance(error, NotModified):
+        logger.info("Command %s not modified since %s", command, error.etag)
+        return build_response(304, '', event, {'ETag': error.etag})
+    error_msg = str(error)
+    if isinstance(error, RateLimited):
+        logger.warning("Rejected %s: %s", command, error_msg)
+        return build_response(429, json.dumps({'error': error_msg}), event, {'Retry-After': str(error.retry_after)})
+    if isinstance(error, CircuitOpen):
+        logger.warning("Failing fast: %s", error_msg)
+        return build_response(503, json.dumps({'error': error_msg}), event, {'Retry-After': str(error.retry_after)})
+    if isinstance(error, CommandInProgress):
+        logger.info("Command %s still in progress: %s", command, error_msg)
+        return build_response(409, json.dumps({'error': error_msg, 'status': 'in_progress'}), event)
+    if isinstance(error, IdempotencyKeyReused):
+        logger.warning("Rejected %s: %s", command, error_msg)
+        return build_response(422, json.dumps({'error': error_msg}), event)
+    if isinstance(error, DeadlineExceeded):
+        logger.warning("Deadline exceeded: %s", error_msg)
+        return build_response(504, json.dumps({'error': error_msg}), event)
+    if isinstance(error, ValueError):
+        logger.warning("Validation error: %s", error_msg)
+        return build_response(400, json.dumps({'error': error_msg}), event)
+    error_msg = f"Internal server error: {error_msg}"
+    logger.error("Error: %s", error_msg, exc_info=error)
+    return build_response(500, json.dumps({'error': error_msg}), event)
+
+def is_streaming_request(command, event):
+    accept = [media_type(part) for part in (request_header(event, 'Accept') or '').split(',')]
+    return NDJSON_CONTENT_TYPE in accept and command in COMMANDS and COMMANDS[command]['stream'] is not None
+
+def stream_command(command, content):
+    entry = COMMANDS[command]
+    items = entry['stream'](**command_args(command, entry, content))
+    return (json.dumps(item, default=json_default) + '\n' for item in items)
+
+def run_background_command(event, context):
+    command = event['background_command']
+    configure_invocation_logging(command, getattr(context, 'aws_request_id', None))
+    handler = BACKGROUND_COMMANDS.get(command)
+    if handler is None:
+        logger.error("Unknown background command %s", command)
+        return {'error': f"Invalid background command: {command}"}
+    content = event.get('content') or {}
+    record = event.get('idempotency')
+    logger.info("Running background command %s with %d ms budget", command, _deadline.remaining_ms())
+    # Passed on again if the command hands off the rest of its work
+    _idempotency.record = record
+    try:
+        result = handler(**content)
+    except Exception:
+        if record:
+            record_idempotent_result(record, {'error': 'failed'}, handed_off=True)
+        raise
+    finally:
+        _idempotency.record = None
+        store.bump_version(content.get('set_name'))
+    if record:
+        record_idempotent_result(record, result, handed_off=True)
+    logger.info("Background command %s finished: %s", command, Truncated(result))
+    return result
+
+def start_background_command(command, content):
+    if not _function_name:
         return False
+    event = {'background_command': command, 'content': content}
+    # The background command records the final result of an idempotent request that handed off to it
+    if getattr(_idempotency, 'record', None):
+        event['idempotency'] = _idempotency.record
+    lambda_client = aws_client('lambda')
+    lambda_client.invoke(
+        FunctionName=_function_name,
+        InvocationType='Event',
+        Payload=json.dumps(event, default=json_default).encode('utf-8')
+    )
+    logger.info("Started background command %s", command)
+    return True
 
-def export_flashcards_to_csv(set_name):
-    print(f"Exporting flashcards from set {set_name} to CSV file")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('flashcards')
-    response = table.scan(
-        FilterExpression='#set = :set_name',
-        ExpressionAttributeNames={
-            '#set': 'set'
-        },
-        ExpressionAttributeValues={
-            ':set_name': set_name
-        }
+# Clients are thread-safe and shared, resources are not and are kept per thread
+_aws_session = None
+_aws_clients = {}
+_aws_resources = threading.local()
+_aws_pool_lock = threading.Lock()
+
+def aws_timeout_bucket():
+    read_timeout = _deadline.timeout(AWS_MAX_READ_TIMEOUT_S)
+    fitting = [bucket for bucket in AWS_TIMEOUT_BUCKETS_S if bucket <= read_timeout]
+    return fitting[-1] if fitting else AWS_TIMEOUT_BUCKETS_S[0]
+
+def aws_config(read_timeout):
+    return Config(
+        connect_timeout=min(AWS_CONNECT_TIMEOUT_S, read_timeout),
+        read_timeout=read_timeout,
+        retries={'mode': AWS_RETRY_MODE, 'max_attempts': 3 if read_timeout > 5 else 1},
+        max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+        tcp_keepalive=AWS_TCP_KEEPALIVE
     )
-    flashcards = response['Items']
-    if not flashcards:
-        return {'msg': f'No flashcards found for set {set_name}'}
-    
-    filename = f'{set_name}_flashcards_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-    tmp_filepath = f"/tmp/{filename}"
-    with open(tmp_filepath, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['Question', 'Answer'])
-        for flashcard in flashcards:
-            writer.writerow([flashcard['question'], flashcard['answer']])
-    
-    s3 = boto3.client('s3')
+
+def aws_session():
+    global _aws_session
+    if _aws_session is None:
+        _aws_session = boto3.session.Session()
+    return _aws_session
+
+def aws_client(service, region_name=None):
+    key = (service, region_name, aws_timeout_bucket())
+    pooled = _aws_clients.get(key)
+    if pooled is None:
+        with _aws_pool_lock:
+            pooled = _aws_clients.get(key)
+            if pooled is None:
+                logger.debug("Creating %s client with %s s read timeout", service, key[2])
+                pooled = aws_session().client(service, region_name=region_name, config=aws_config(key[2]))
+                _aws_clients[key] = pooled
+    return pooled
+
+def dynamodb_resource():
+    bucket = aws_timeout_bucket()
+    resources = getattr(_aws_resources, 'dynamodb', None)
+    if resources is None:
+        resources = _aws_resources.dynamodb = {}
+    if bucket not in resources:
+        with _aws_pool_lock:
+            resources[bucket] = aws_session().resource('dynamodb', config=aws_config(bucket))
+    return resources[bucket]
+
+def s3_client():
+    return aws_client('s3')
+
+def gemini_http_options(reserve_ms=GEMINI_RESERVE_MS):
+    timeout_ms = _deadline.remaining_ms() - reserve_ms
+    if timeout_ms < GEMINI_MIN_TIMEOUT_MS:
+        raise DeadlineExceeded(f"Not enough time left to call Gemini ({_deadline.remaining_ms()} ms remaining)")
+    return types.HttpOptions(timeout=timeout_ms)
+
+def generate_content(**kwargs):
+    try:
+        try:
+            return CIRCUITS['gemini'].call(require_gemini_client().models.generate_content, **kwargs)
+        except Exception as e:
+            if getattr(e, 'code', None) not in (401, 403):
+                raise
+            # The key may have been rotated since it was cached
+            logger.warning("Gemini rejected the API key, reloading it: %s", e)
+            set_gemini_apikey(force=True)
+            return CIRCUITS['gemini'].call(require_gemini_client().models.generate_content, **kwargs)
+    except Exception as e:
+        if not _deadline.has(GEMINI_RESERVE_MS):
+            raise DeadlineExceeded(f"Gemini did not answer before the request deadline: {e}") from e
+        raise
+
+def request_header(event, name):
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+def accepted_encodings(event):
+    accepted = {}
+    for part in (request_header(event, 'Accept-Encoding') or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+    return accepted
+
+def media_type(value):
+    return (value or '').split(';')[0].strip().lower()
+
+def decode_request_body(event):
+    body = event.get('body')
+    if not body:
+        raise ValueError("Request body is empty")
+    raw = body.encode('utf-8') if isinstance(body, str) else body
+    if event.get('isBase64Encoded'):
+        try:
+            raw = base64.b64decode(raw)
+        except Exception as e:
+            raise ValueError(f"Failed to decode base64 body: {str(e)}")
+
+    if media_type(request_header(event, 'Content-Type')) in MSGPACK_CONTENT_TYPES:
+        if msgpack is None:
+            raise ValueError("MessagePack requests are not supported by this deployment")
+        try:
+            return msgpack.unpackb(raw, raw=False)
+        except Exception as e:
+            raise ValueError(f"Failed to parse MessagePack body: {str(e)}")
+
+    try:
+        return json.loads(raw)
+    except ValueError:
+        pass
+    # Older clients send the JSON document base64 encoded inside the body
+    try:
+        return json.loads(base64.b64decode(raw, validate=True))
+    except Exception as e:
+        raise ValueError(f"Failed to parse JSON body: {str(e)}")
+
+def encode_response_body(result, event):
+    accept = [media_type(part) for part in (request_header(event, 'Accept') or '').split(',')]
+    if msgpack is not None and any(part in MSGPACK_CONTENT_TYPES for part in accept):
+        return msgpack.packb(result, default=json_default, use_bin_type=True), MSGPACK_CONTENT_TYPES[0]
+    return json.dumps(result, default=json_default), 'application/json'
+
+def columnar(items):
+    columns = {}
+    for item in items:
+        for key in item:
+            columns.setdefault(key, [])
+    for key, values in columns.items():
+        values.extend(item.get(key) for item in items)
+    return columns
+
+def compress_body(body, event):
+    if len(body) < COMPRESSION_MIN_BYTES:
+        return body, None
+    accepted = accepted_encodings(event)
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+    if accepted.get('gzip', 0) > 0:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), 'gzip'
+    return body, None
+
+def build_response(status_code, body, event, headers=None):
+    response_headers = {'Content-Type': 'application/json', 'Vary': 'Accept, Accept-Encoding'}
+    response_headers.update(CORS_HEADERS)
+    response_headers.update(headers or {})
+    raw = body.encode('utf-8') if isinstance(body, str) else body
+    encoded, encoding = compress_body(raw, event)
+    if encoding is None and isinstance(body, str):
+        return {'statusCode': status_code, 'headers': response_headers, 'body': body}
+    if encoding is not None:
+        logger.debug("Compressed response from %d to %d bytes with %s", len(raw), len(encoded), encoding)
+        response_headers['Content-Encoding'] = encoding
+    return {
+        'statusCode': status_code,
+        'headers': response_headers,
+        'body': base64.b64encode(encoded).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def spill_response(status_code, body, content_type, event, headers):
+    raw = body.encode('utf-8') if isinstance(body, str) else body
+    key = f"responses/{uuid.uuid4().hex}"
+    s3 = s3_client()
+    CIRCUITS['s3'].call(
+        s3.put_object,
+        Bucket=RESPONSE_SPILL_BUCKET,
+        Key=key,
+        Body=gzip.compress(raw, compresslevel=GZIP_LEVEL),
+        ContentType=content_type,
+        ContentEncoding='gzip'
+    )
+    url = s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': RESPONSE_SPILL_BUCKET, 'Key': key},
+        ExpiresIn=RESPONSE_SPILL_URL_TTL
+    )
+    logger.info("Response of %d bytes spilled to s3://%s/%s", len(raw), RESPONSE_SPILL_BUCKET, key)
+    spilled = {
+        'spilled': True,
+        'url': url,
+        'size': len(raw),
+        'content_type': content_type,
+        'expires_in': RESPONSE_SPILL_URL_TTL
+    }
+    if 'ETag' in headers:
+        spilled['etag'] = headers['ETag']
+    return build_response(status_code, json.dumps(spilled), event, {k: v for k, v in headers.items() if k != 'Content-Type'})
+
+def command_dispatch(command, content, if_none_match=None):
+    entry = COMMANDS.get(command)
+    if entry is None:
+        raise ValueError(f"Invalid command: {command}")
+    args = command_args(command, entry, content)
+    # Card and set lists can be returned as one array per attribute instead of one dict per item
+    shape = content.get('shape') if entry['columnar'] and isinstance(content, dict) else None
+
+    etag = response_etag = None
+    if entry['etag'] is not None:
+        etag = entry['etag'](**args)
+        # The columnar body is another representation, so it has its own ETag. The read cache holds
+        # the row result under the plain one.
+        response_etag = make_etag(f"columnar:{etag}", 0) if etag and shape == 'columnar' else etag
+        if if_none_match and response_etag in [tag.strip() for tag in if_none_match.split(',')]:
+            raise NotModified(response_etag)
+
+    run = lambda: entry['handler'](**args)
+    idempotency_key = content.get('idempotency_key') if isinstance(content, dict) else None
+    if idempotency_key and entry['idempotent']:
+        run = lambda: run_idempotent(command, idempotency_key, args, lambda: entry['handler'](**args))
+
+    if not entry['mutates']:
+        # The ETag was just derived from the set version, so a cached result with the same one is current
+        cache_key = (command, json.dumps(args, sort_keys=True, default=json_default)) if entry['cache'] and etag else None
+        result = cache_get(cache_key, etag) if cache_key else None
+        if result is None:
+            result = run()
+            if cache_key and 'msg' in result:
+                cache_put(cache_key, etag, args.get('set_name'), result)
+        if response_etag and 'msg' in result:
+            result['etag'] = response_etag
+        if shape == 'columnar' and isinstance(result.get('msg'), list):
+            result['msg'] = columnar(result['msg'])
+        return result
+    try:
+        return run()
+    finally:
+        store.bump_version(args.get('set_name', args.get('name')))
+        cache_invalidate(args.get('set_name', args.get('name')))
+
+def caller_id(event):
+    request_context = event.get('requestContext') or {}
+    identity = request_context.get('identity') or {}
+    # API Gateway only fills in identity.apiKey for methods that require a key, after validating it
+    if identity.get('apiKey'):
+        return f"key:{identity['apiKey']}"
+    # Clients can put anything in X-Forwarded-For, only the last hop is added by the load balancer
+    forwarded_for = (request_header(event, 'X-Forwarded-For') or '').split(',')[-1].strip()
+    source_ip = identity.get('sourceIp') or (request_context.get('http') or {}).get('sourceIp') or forwarded_for
+    return f"ip:{source_ip or 'unknown'}"
+
+def rate_tier(entry, content):
+    # A callable rate picks the tier from the request content
+    if callable(entry['rate']):
+        return entry['rate'](content if isinstance(content, dict) else {})
+    return entry['rate']
+
+def rate_limit_costs(command, content):
+    if command == 'batch':
+        costs = {}
+        sub_commands = content.get('commands') if isinstance(content, dict) else None
+        for sub_command in sub_commands if isinstance(sub_commands, list) else []:
+            entry = COMMANDS.get(sub_command.get('command')) if isinstance(sub_command, dict) else None
+            if entry is not None:
+                tier = rate_tier(entry, sub_command.get('content'))
+                costs[tier] = costs.get(tier, 0) + 1
+        return costs
+    entry = COMMANDS.get(command)
+    return {rate_tier(entry, content): 1} if entry is not None else {}
+
+def enforce_rate_limits(caller, command, content):
+    for tier, cost in rate_limit_costs(command, content).items():
+        if tier in RATE_LIMITS:
+            take_tokens(caller, tier, cost)
+
+# Last known bucket state per key, used to reject callers that are clearly over their limit
+# without a DynamoDB round trip, and tokens leased from the shared bucket as (tokens, expires_at_ms)
+_local_buckets = {}
+_local_leases = {}
+_local_buckets_lock = threading.Lock()
+
+def refill(tokens, updated_at_ms, now_ms, rate, burst):
+    return min(burst, tokens + max(0, now_ms - updated_at_ms) / 1000.0 * rate)
+
+def take_tokens(caller, tier, cost):
+    rate, burst = RATE_LIMITS[tier]
+    key = f"{caller}#{tier}"
+    now_ms = int(time.time() * 1000)
+    retry_after = lambda tokens: max(1, math.ceil((cost - tokens) / rate)) if rate > 0 else 3600
+
+    with _local_buckets_lock:
+        lease = _local_leases.get(key)
+        if lease is not None and lease[1] > now_ms and lease[0] >= cost:
+            _local_leases[key] = (lease[0] - cost, lease[1])
+            return
+        local = _local_buckets.get(key)
+    if local is not None:
+        tokens = refill(local[0], local[1], now_ms, rate, burst)
+        if tokens < cost:
+            raise RateLimited(tier, retry_after(tokens))
+
+    table = dynamodb_resource().Table(RATE_LIMIT_TABLE)
+    try:
+        for _ in range(3):
+            item = table.get_item(Key={'key': key}, ConsistentRead=True).get('Item')
+            if item is None:
+                tokens = float(burst)
+                condition = {
+                    'ConditionExpression': 'attribute_not_exists(#k)',
+                    'ExpressionAttributeNames': {'#k': 'key'}
+                }
+            else:
+                tokens = refill(float(item['tokens']), int(item['updated_at']), now_ms, rate, burst)
+                condition = {
+                    'ConditionExpression': 'updated_at = :previous',
+                    'ExpressionAttributeValues': {':previous': item['updated_at']}
+                }
+            if tokens < cost:
+                with _local_buckets_lock:
+                    _local_buckets[key] = (tokens, now_ms)
+                raise RateLimited(tier, retry_after(tokens))
+            # Leased tokens left unused when the lease expires are lost, which only makes the limit stricter
+            taken = max(cost, min(RATE_LEASES.get(tier, 0), tokens))
+            try:
+                table.put_item(
+                    Item={
+                        'key': key,
+                        'tokens': Decimal(str(round(tokens - taken, 3))),
+                        'updated_at': now_ms,
+                        # Once full again the bucket is equivalent to a missing one
+                        'expires_at': int(time.time() + (burst / rate if rate > 0 else 3600)) + 60
+                    },
+                    **condition
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                # Another request updated the bucket in the meantime, re-read it
+                now_ms = int(time.time() * 1000)
+                continue
+            with _local_buckets_lock:
+                _local_buckets[key] = (tokens - taken, now_ms)
+                if taken > cost:
+                    _local_leases[key] = (taken - cost, now_ms + RATE_LEASE_MS)
+            return
+    except ClientError as e:
+        # A missing or throttled rate limit table must not take the whole API down
+        logger.warning("Rate limiting unavailable, allowing request: %s", e)
+        return
+    raise RateLimited(tier, 1)
+
+def run_idempotent(command, idempotency_key, args, run):
+    table = dynamodb_resource().Table(IDEMPOTENCY_TABLE)
+    key = {'key': f"{command}#{_caller}#{idempotency_key}"}
+    # A key reused with other arguments is a client bug, replaying the first result would hide it
+    args_hash = hashlib.sha256(json.dumps(args, sort_keys=True, default=json_default).encode('utf-8')).hexdigest()
+    now = int(time.time())
+    try:
+        table.put_item(
+            Item=dict(key, status='IN_PROGRESS', args_hash=args_hash, locked_until=now + IDEMPOTENCY_LOCK_S, expires_at=now + IDEMPOTENCY_TTL_S),
+            ConditionExpression='attribute_not_exists(#k) OR expires_at < :now OR (#s = :in_progress AND locked_until < :now)',
+            ExpressionAttributeNames={'#k': 'key', '#s': 'status'},
+            ExpressionAttributeValues={':now': now, ':in_progress': 'IN_PROGRESS'}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        existing = table.get_item(Key=key, ConsistentRead=True).get('Item', {})
+        if existing and existing.get('args_hash') != args_hash:
+            raise IdempotencyKeyReused(f"Idempotency key {idempotency_key} was already used for a {command} request with different arguments")
+        if existing.get('status') in ('COMPLETED', 'ACCEPTED'):
+            logger.info("Replaying stored result for %s idempotency key %s", command, idempotency_key)
+            return json.loads(existing['result'])
+        raise CommandInProgress(f"A {command} request with idempotency key {idempotency_key} is still in progress")
+
+    record = {'key': key['key'], 'args_hash': args_hash}
+    _idempotency.record = record
+    try:
+        result = run()
+    except Exception:
+        table.delete_item(Key=key)
+        raise
+    finally:
+        _idempotency.record = None
+    record_idempotent_result(record, result)
+    return result
+
+def record_idempotent_result(record, result, handed_off=False):
+    # A command handed off to the background stays ACCEPTED until the background command records its own
+    # result. The background command may finish before the request does, so neither overwrites a final result.
+    table = dynamodb_resource().Table(IDEMPOTENCY_TABLE)
+    key = {'key': record['key']}
+    condition = {
+        'ConditionExpression': '#s IN (:in_progress, :accepted)' if handed_off else '#s = :in_progress',
+        'ExpressionAttributeNames': {'#s': 'status'},
+        'ExpressionAttributeValues': {':in_progress': 'IN_PROGRESS', ':accepted': 'ACCEPTED'} if handed_off else {':in_progress': 'IN_PROGRESS'}
+    }
+    try:
+        if 'msg' not in result or result.get('partial'):
+            # Failed and partial executions are not remembered so that the client can retry or resume them
+            table.delete_item(Key=key, **condition)
+            return
+        table.put_item(Item=dict(
+            key,
+            status='ACCEPTED' if result.get('status') == 'accepted' else 'COMPLETED',
+            args_hash=record['args_hash'],
+            result=json.dumps(result, default=json_default),
+            expires_at=int(time.time()) + IDEMPOTENCY_TTL_S
+        ), **condition)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def command_args(command, entry, content):
+    if not isinstance(content, dict):
+        content = {}
+    missing = [name for name in entry['required'] if name not in content]
+    if missing:
+        raise ValueError(f"Missing required field(s) for {command}: {', '.join(missing)}")
+    args = {name: content[name] for name in entry['required']}
+    for name, default in entry['optional'].items():
+        args[name] = content.get(name, default)
+    return args
+
+def now_ms():
+    return int(time.time() * 1000)
+
+# The resource layer turns every number into a Decimal through TypeDeserializer, which costs more per
+# card than the query itself on big sets. Card attributes are only ever strings and integers, so the
+# low-level client output is converted directly into JSON-ready values.
+_boto3_deserializer = TypeDeserializer()
+_boto3_serializer = TypeSerializer()
+
+def deserialize_value(value):
+    (kind, raw), = value.items()
+    if kind == 'S':
+        return raw
+    if kind == 'N':
+        return int(raw) if raw.lstrip('-').isdigit() else float(raw)
+    if kind == 'B':
+        return raw
+    return _boto3_deserializer.deserialize(value)
+
+def deserialize_item(item):
+    return {name: deserialize_value(value) for name, value in item.items()}
+
+def serialize_value(value):
+    if isinstance(value, str):
+        return {'S': value}
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if isinstance(value, (int, float, Decimal)):
+        return {'N': str(value)}
+    return _boto3_serializer.serialize(value)
+
+def serialize_item(item):
+    return {name: serialize_value(value) for name, value in item.items()}
+
+def query_items(table_name, **kwargs):
+    dynamodb = aws_client('dynamodb')
+    if 'ExpressionAttributeValues' in kwargs:
+        kwargs['ExpressionAttributeValues'] = serialize_item(kwargs['ExpressionAttributeValues'])
+    while True:
+        response = dynamodb.query(TableName=table_name, **kwargs)
+        for item in response['Items']:
+            yield deserialize_item(item)
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+class FlashcardStore:
+    # All command reads and writes of sets, cards and tombstones, on the pooled low-level client
+    def __init__(self, flashcards_table='flashcards', sets_table='sets', tombstones_table=TOMBSTONE_TABLE):
+        self.flashcards_table = flashcards_table
+        self.sets_table = sets_table
+        self.tombstones_table = tombstones_table
+
+    @property
+    def dynamodb(self):
+        # Fetched per call, the pool hands out clients matching the remaining deadline
+        return aws_client('dynamodb')
+
+    def query_cards(self, set_name, since=None, fields=None, **kwargs):
+        kwargs.update(card_projection(fields))
+        if since is None:
+            # Served under an ETag taken from a strongly consistent version read, so the data must not be older
+            items = query_items(
+                self.flashcards_table,
+                KeyConditionExpression='#set = :set_name',
+                ExpressionAttributeNames=dict(kwargs.pop('ExpressionAttributeNames', {}), **{'#set': 'set'}),
+                ExpressionAttributeValues={':set_name': set_name},
+                ConsistentRead=True,
+                **kwargs
+            )
+        else:
+            items = query_items(
+                self.flashcards_table,
+                IndexName=FLASHCARDS_UPDATED_INDEX,
+                KeyConditionExpression='#set = :set_name AND updated_at > :since',
+                ExpressionAttributeNames=dict(kwargs.pop('ExpressionAttributeNames', {}), **{'#set': 'set'}),
+                ExpressionAttributeValues={':set_name': set_name, ':since': since},
+                **kwargs
+            )
+        return (self.decode_card(item) for item in items)
+
+    def query_cards_page(self, set_name, page_size, cursor=None, fields=None):
+        kwargs = card_projection(fields)
+        if cursor:
+            kwargs['ExclusiveStartKey'] = decode_cursor(cursor, 'set', set_name, {'set', 'id'})
+        response = self.dynamodb.query(
+            TableName=self.flashcards_table,
+            KeyConditionExpression='#set = :set_name',
+            ExpressionAttributeNames=dict(kwargs.pop('ExpressionAttributeNames', {}), **{'#set': 'set'}),
+            ExpressionAttributeValues=serialize_item({':set_name': set_name}),
+            Limit=page_size,
+            ConsistentRead=True,
+            **kwargs
+        )
+        items = [self.decode_card(deserialize_item(item)) for item in response['Items']]
+        return items, encode_cursor(response.get('LastEvaluatedKey'))
+
+    def get_card(self, set_name, id, fields=None):
+        response = self.dynamodb.get_item(
+            TableName=self.flashcards_table,
+            Key=serialize_item({'set': set_name, 'id': id}),
+            **card_projection(fields)
+        )
+        item = response.get('Item')
+        return self.decode_card(deserialize_item(item)) if item is not None else None
+
+    def deleted_since(self, set_name, since):
+        return query_items(
+            self.tombstones_table,
+            KeyConditionExpression='#set = :set_name',
+            FilterExpression='updated_at > :since',
+            ExpressionAttributeNames={'#set': 'set'},
+            ExpressionAttributeValues={':set_name': set_name, ':since': since}
+        )
+
+    def card_item(self, set_name, question, answer, id):
+        return {'set': set_name, 'id': id, 'question': question, 'answer': answer, 'updated_at': now_ms()}
+
+    def encode_answer(self, set_name, id, question, answer):
+        # Returns the stored form of an answer: plain, compressed binary or a pointer to S3
+        data = answer.encode('utf-8')
+        if len(data) < ANSWER_COMPRESS_MIN_BYTES:
+            return {'answer': answer}
+        codec, compressed = compress_answer(data)
+        if len(compressed) >= len(data):
+            return {'answer': answer}
+        if len(compressed) + utf8_length(question) <= ANSWER_OFFLOAD_BYTES:
+            return {'answer': compressed, 'answer_codec': codec, 'answer_size': len(data)}
+        # Unique per write, so a write that loses an id collision or a card update never overwrites an answer in use
+        key = f"answers/{urllib.parse.quote(set_name, safe='')}/{id}-{uuid.uuid4().hex[:8]}"
+        CIRCUITS['s3'].call(s3_client().put_object, Bucket=ANSWER_BUCKET, Key=key, Body=compressed, ContentEncoding=codec)
+        logger.info("Offloaded %d byte answer of flashcard %s to s3://%s/%s", len(data), id, ANSWER_BUCKET, key)
+        return {'answer_ref': f"{ANSWER_BUCKET}/{key}", 'answer_codec': codec, 'answer_size': len(data)}
+
+    def decode_card(self, item):
+        codec = item.pop('answer_codec', None)
+        ref = item.pop('answer_ref', None)
+        item.pop('answer_size', None)
+        if ref is not None:
+            bucket, key = ref.split('/', 1)
+            try:
+                item['answer'] = CIRCUITS['s3'].call(s3_client().get_object, Bucket=bucket, Key=key)['Body'].read()
+            except (ClientError, CircuitOpen) as e:
+                # One lost or unreachable answer must not fail the whole set
+                logger.error("Cannot read offloaded answer of flashcard %s from s3://%s: %s", item.get('id'), ref, e)
+                item['answer'] = ''
+                item['answer_error'] = 'Answer is unavailable'
+                return item
+        if codec is not None and 'answer' in item:
+            item['answer'] = decompress_answer(codec, item['answer'])
+        return item
+
+    def stored_card_item(self, set_name, question, answer, id):
+        item = self.card_item(set_name, question, answer, id)
+        del item['answer']
+        item.update(self.encode_answer(set_name, id, question, answer))
+        return item
+
+    def put_card(self, set_name, question, answer):
+        # Containers pick their worker id at random, so two of them can generate the same id
+        for attempt in range(ID_PUT_ATTEMPTS):
+            id = next_card_ids(1)[0]
+            item = self.stored_card_item(set_name, question, answer, id)
+            try:
+                self.dynamodb.put_item(
+                    TableName=self.flashcards_table,
+                    Item=serialize_item(item),
+                    ConditionExpression='attribute_not_exists(#id)',
+                    ExpressionAttributeNames={'#id': 'id'}
+                )
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException' or attempt == ID_PUT_ATTEMPTS - 1:
+                    raise
+                logger.warning("Flashcard id %s is already taken in set %s, retrying with a new id", id, set_name)
+                if 'answer_ref' in item:
+                    self.delete_offloaded_answer(item['answer_ref'])
+        self.adjust_set_counters(set_name, 1, utf8_length(answer))
+        return self.card_item(set_name, question, answer, id)
+
+    def put_cards(self, set_name, cards):
+        # cards are (question, answer) pairs. BatchWriteItem cannot be conditional, so unlike put_card
+        # a colliding id from another container with the same worker id overwrites that card
+        ids = next_card_ids(len(cards))
+        items = [self.stored_card_item(set_name, question, answer, id) for (question, answer), id in zip(cards, ids)]
+        self.batch_write(self.flashcards_table, [{'PutRequest': {'Item': serialize_item(item)}} for item in items])
+        if items:
+            self.adjust_set_counters(set_name, len(items), sum(utf8_length(answer) for _, answer in cards))
+        return [self.card_item(set_name, question, answer, id) for (question, answer), id in zip(cards, ids)]
+
+    def update_card(self, set_name, id, question, answer):
+        stored = dict(self.encode_answer(set_name, id, question, answer), question=question, updated_at=now_ms())
+        removed = [name for name in ANSWER_STORAGE_ATTRIBUTES if name not in stored]
+        names = {f'#a{index}': name for index, name in enumerate(list(stored) + removed)}
+        placeholders = {name: placeholder for placeholder, name in names.items()}
+        update = 'SET ' + ', '.join(f'{placeholders[name]} = :{placeholders[name][1:]}' for name in stored)
+        if removed:
+            update += ' REMOVE ' + ', '.join(placeholders[name] for name in removed)
+        response = self.dynamodb.update_item(
+            TableName=self.flashcards_table,
+            Key=serialize_item({'set': set_name, 'id': id}),
+            UpdateExpression=update,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=serialize_item({f':{placeholders[name][1:]}': value for name, value in stored.items()}),
+            ReturnValues='ALL_OLD'
+        )
+        old = deserialize_item(response.get('Attributes', {}))
+        if old.get('answer_ref') and old['answer_ref'] != stored.get('answer_ref'):
+            self.delete_offloaded_answer(old['answer_ref'])
+        # Updating a card that does not exist creates it
+        self.adjust_set_counters(set_name, 0 if 'id' in old else 1, utf8_length(answer) - stored_answer_size(old))
+
+    def delete_card(self, set_name, id):
+        response = self.dynamodb.delete_item(
+            TableName=self.flashcards_table,
+            Key=serialize_item({'set': set_name, 'id': id}),
+            ReturnValues='ALL_OLD'
+        )
+        if 'Attributes' in response:
+            old = deserialize_item(response['Attributes'])
+            if old.get('answer_ref'):
+                self.delete_offloaded_answer(old['answer_ref'])
+            self.adjust_set_counters(set_name, -1, -stored_answer_size(old))
+        self.dynamodb.put_item(TableName=self.tombstones_table, Item=serialize_item({
+            'set': set_name,
+            'id': id,
+            'updated_at': now_ms(),
+            'expires_at': int(time.time()) + TOMBSTONE_TTL_S
+        }))
+
+    def delete_offloaded_answer(self, ref):
+        bucket, key = ref.split('/', 1)
+        try:
+            CIRCUITS['s3'].call(s3_client().delete_object, Bucket=bucket, Key=key)
+        except Exception as e:
+            logger.warning("Error deleting offloaded answer %s: %s", ref, e)
+
+    def delete_offloaded_answers(self, set_name):
+        # Batch deletes do not return the old items, so a purged set's answers are removed by prefix
+        s3 = s3_client()
+        prefix = f"answers/{urllib.parse.quote(set_name, safe='')}/"
+        for page in s3.get_paginator('list_objects_v2').paginate(Bucket=ANSWER_BUCKET, Prefix=prefix):
+            keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if keys:
+                CIRCUITS['s3'].call(s3.delete_objects, Bucket=ANSWER_BUCKET, Delete={'Objects': keys, 'Quiet': True})
+
+    def delete_cards(self, set_name, ids):
+        self.batch_write(self.flashcards_table, [
+            {'DeleteRequest': {'Key': serialize_item({'set': set_name, 'id': id})}} for id in ids
+        ])
+
+    def batch_write(self, table_name, requests):
+        for start in range(0, len(requests), BATCH_WRITE_SIZE):
+            pending = {table_name: requests[start:start + BATCH_WRITE_SIZE]}
+            attempt = 0
+            while pending:
+                response = self.dynamodb.batch_write_item(RequestItems=pending)
+                pending = response.get('UnprocessedItems') or {}
+                if not pending:
+                    break
+                attempt += 1
+                if attempt >= BATCH_WRITE_MAX_ATTEMPTS:
+                    raise RuntimeError(f"{len(pending[table_name])} writes to {table_name} still unprocessed after {attempt} attempts")
+                # Exponential backoff with full jitter, the table is throttling us
+                delay_ms = random.uniform(0, min(BATCH_WRITE_MAX_BACKOFF_MS, BATCH_WRITE_BASE_BACKOFF_MS * 2 ** attempt))
+                logger.warning("Retrying %d unprocessed writes to %s in %d ms", len(pending[table_name]), table_name, delay_ms)
+                _deadline.check(delay_ms + WRITE_BUDGET_MS, "retrying unprocessed writes")
+                time.sleep(delay_ms / 1000)
+
+    def get_set(self, set_name):
+        item = self.dynamodb.get_item(TableName=self.sets_table, Key=serialize_item({'name': set_name}), ConsistentRead=True).get('Item')
+        if item is None or 'deleting' in item:
+            return None
+        return deserialize_item(item)
+
+    def is_set_deleting(self, set_name):
+        response = self.dynamodb.get_item(
+            TableName=self.sets_table,
+            Key=serialize_item({'name': set_name}),
+            ProjectionExpression='deleting',
+            ConsistentRead=True
+        )
+        return 'deleting' in response.get('Item', {})
+
+    def mark_set_deleting(self, set_name):
+        # Dropping kind takes the set out of the sorted indexes, scans and reads skip it from here on
+        self.dynamodb.update_item(
+            TableName=self.sets_table,
+            Key=serialize_item({'name': set_name}),
+            UpdateExpression='SET deleting = :now, purge_status = :status, purge_deleted = :zero REMOVE kind',
+            ExpressionAttributeValues=serialize_item({':now': datetime.now().isoformat(), ':status': 'pending', ':zero': 0})
+        )
+
+    def record_purge_progress(self, set_name, deleted, status):
+        self.dynamodb.update_item(
+            TableName=self.sets_table,
+            Key=serialize_item({'name': set_name}),
+            UpdateExpression='ADD purge_deleted :deleted SET purge_status = :status',
+            ConditionExpression='attribute_exists(deleting)',
+            ExpressionAttributeValues=serialize_item({':deleted': deleted, ':status': status})
+        )
+
+    def mark_set_restored(self, set_name):
+        self.dynamodb.update_item(
+            TableName=self.sets_table,
+            Key=serialize_item({'name': set_name}),
+            UpdateExpression='SET restored_at = :now',
+            ExpressionAttributeValues=serialize_item({':now': now_ms()})
+        )
+
+    def purge_progress(self, set_name):
+        response = self.dynamodb.get_item(
+            TableName=self.sets_table,
+            Key=serialize_item({'name': set_name}),
+            ProjectionExpression='deleting, purge_status, purge_deleted',
+            ConsistentRead=True
+        )
+        return deserialize_item(response['Item']) if 'Item' in response else None
+
+    def adjust_set_counters(self, set_name, cards, answer_bytes):
+        try:
+            self.dynamodb.update_item(
+                TableName=self.sets_table,
+                Key=serialize_item({'name': set_name}),
+                UpdateExpression='ADD card_count :cards, answer_bytes :bytes SET last_modified = :now',
+                ConditionExpression='attribute_exists(#n)',
+                ExpressionAttributeNames={'#n': 'name'},
+                ExpressionAttributeValues=serialize_item({':cards': cards, ':bytes': answer_bytes, ':now': datetime.now().isoformat()})
+            )
+        except ClientError as e:
+            # Cards written to a set that does not exist (any more) have nothing to count against
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+
+    def put_new_set(self, item):
+        # kind is the constant partition key of the sorted set indexes, the '#sets' version item has none
+        item = dict(item, kind=SET_KIND, card_count=0, answer_bytes=0, last_modified=item['created_at'])
+        self.dynamodb.put_item(
+            TableName=self.sets_table,
+            Item=serialize_item(item),
+            ConditionExpression='attribute_not_exists(#n)',
+            ExpressionAttributeNames={'#n': 'name'}
+        )
+
+    def delete_set(self, set_name):
+        self.dynamodb.delete_item(TableName=self.sets_table, Key=serialize_item({'name': set_name}))
+
+    def query_sets_page(self, sort, ascending, page_size, cursor=None):
+        kwargs = {}
+        if cursor:
+            kwargs['ExclusiveStartKey'] = decode_cursor(cursor, 'kind', SET_KIND, {'kind', 'name', sort})
+        response = self.dynamodb.query(
+            TableName=self.sets_table,
+            IndexName=SETS_SORT_INDEXES[sort],
+            KeyConditionExpression='kind = :kind',
+            ExpressionAttributeValues=serialize_item({':kind': SET_KIND}),
+            ScanIndexForward=ascending,
+            Limit=page_size,
+            **kwargs
+        )
+        items = [deserialize_item(item) for item in response['Items']]
+        return items, encode_cursor(response.get('LastEvaluatedKey'))
+
+    def backfill_set_aggregates(self):
+        # One-off for sets created before the aggregates existed, run while nothing else writes cards
+        backfilled = 0
+        for set_item in list(self.scan_sets()):
+            # The stored sizes are enough, offloaded answers are not fetched
+            cards = list(query_items(
+                self.flashcards_table,
+                KeyConditionExpression='#set = :set_name',
+                ProjectionExpression='answer, answer_size',
+                ExpressionAttributeNames={'#set': 'set'},
+                ExpressionAttributeValues={':set_name': set_item['name']}
+            ))
+            self.dynamodb.update_item(
+                TableName=self.sets_table,
+                Key=serialize_item({'name': set_item['name']}),
+                UpdateExpression='SET kind = :kind, card_count = :cards, answer_bytes = :bytes, last_modified = if_not_exists(last_modified, :created)',
+                ExpressionAttributeValues=serialize_item({
+                    ':kind': SET_KIND,
+                    ':cards': len(cards),
+                    ':bytes': sum(stored_answer_size(card) for card in cards),
+                    ':created': set_item.get('created_at') or datetime.now().isoformat()
+                })
+            )
+            backfilled += 1
+        return backfilled
+
+    def scan_sets(self):
+        kwargs = {}
+        while True:
+            response = self.dynamodb.scan(TableName=self.sets_table, ConsistentRead=True, **kwargs)
+            for item in response['Items']:
+                item = deserialize_item(item)
+                if item['name'] != SETS_VERSION_KEY and 'deleting' not in item:
+                    yield item
+            if 'LastEvaluatedKey' not in response:
+                return
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def bump_version(self, set_name):
+        if set_name:
+            try:
+                self.dynamodb.update_item(
+                    TableName=self.sets_table,
+                    Key=serialize_item({'name': set_name}),
+                    UpdateExpression='ADD #v :one',
+                    ConditionExpression='attribute_exists(#n)',
+                    ExpressionAttributeNames={'#v': 'version', '#n': 'name'},
+                    ExpressionAttributeValues=serialize_item({':one': 1})
+                )
+            except ClientError as e:
+                # The set itself may have just been deleted
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+        self.dynamodb.update_item(
+            TableName=self.sets_table,
+            Key=serialize_item({'name': SETS_VERSION_KEY}),
+            UpdateExpression='ADD #v :one',
+            ExpressionAttributeNames={'#v': 'version'},
+            ExpressionAttributeValues=serialize_item({':one': 1})
+        )
+
+    def read_version(self, set_name):
+        response = self.dynamodb.get_item(
+            TableName=self.sets_table,
+            Key=serialize_item({'name': set_name}),
+            ProjectionExpression='#v',
+            ExpressionAttributeNames={'#v': 'version'},
+            ConsistentRead=True
+        )
+        return deserialize_item(response.get('Item', {})).get('version', 0)
+
+def card_projection(fields):
+    if not fields:
+        return {}
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    fields = [field.strip() for field in fields]
+    unknown = [field for field in fields if field not in FLASHCARD_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown flashcard field(s): {', '.join(unknown)}")
+    # The key is always returned so a projected card can still be fetched or edited
+    fields = ['id'] + [field for field in dict.fromkeys(fields) if field != 'id']
+    if 'answer' in fields:
+        fields += ['answer_codec', 'answer_ref']
+    names = {f'#f{index}': field for index, field in enumerate(fields)}
+    return {'ProjectionExpression': ', '.join(names), 'ExpressionAttributeNames': names}
+
+def compress_answer(data):
+    if ANSWER_CODEC == 'zstd' and zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor().compress(data)
+    return 'zlib', zlib.compress(data, ANSWER_ZLIB_LEVEL)
+
+def decompress_answer(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd compressed answers")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    return zlib.decompress(data).decode('utf-8')
+
+def stored_answer_size(item):
+    if 'answer_size' in item:
+        return item['answer_size']
+    return utf8_length(item['answer']) if isinstance(item.get('answer'), str) else 0
+
+def encode_cursor(last_evaluated_key):
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, partition_key, partition_value, key_names):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if key.get(partition_key) != {'S': partition_value} or not set(key) <= key_names:
+            raise ValueError("cursor belongs to another listing")
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    return key
+
+# Snowflake ids: 41 bits of milliseconds since ID_EPOCH_MS, 7 bits of worker and 5 bits of sequence.
+# That is 53 bits, so ids stay exact as JavaScript numbers, and they sort after the old timestamp ids.
+_id_worker = ID_WORKER_ID if ID_WORKER_ID is not None else random.getrandbits(ID_WORKER_BITS)
+_id_last_ms = 0
+_id_sequence = 0
+_id_lock = threading.Lock()
+
+def next_card_ids(count):
+    global _id_last_ms, _id_sequence
+    ids = []
+    with _id_lock:
+        # Never step back, even if the wall clock does
+        current_ms = max(now_ms() - ID_EPOCH_MS, _id_last_ms)
+        if current_ms > _id_last_ms:
+            _id_last_ms, _id_sequence = current_ms, 0
+        prefix = _id_worker << ID_SEQUENCE_BITS
+        for _ in range(count):
+            if _id_sequence >> ID_SEQUENCE_BITS:
+                # Sequence exhausted: borrow the next millisecond instead of sleeping, the wall clock
+                # catches up once the burst is over
+                _id_last_ms += 1
+                _id_sequence = 0
+            ids.append((_id_last_ms << ID_TIMESTAMP_SHIFT) | prefix | _id_sequence)
+            _id_sequence += 1
+    return ids
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+store = FlashcardStore()
+
+# Read results kept by warm containers between invocations, least recently used first
+_read_cache = OrderedDict()
+_read_cache_bytes = 0
+_read_cache_lock = threading.Lock()
+_read_cache_stats = {'hits': 0, 'misses': 0, 'stale': 0, 'expired': 0, 'evictions': 0, 'invalidations': 0}
+
+def cache_get(key, etag):
+    with _read_cache_lock:
+        entry = _read_cache.get(key)
+        if entry is None:
+            _read_cache_stats['misses'] += 1
+            return None
+        if entry['etag'] != etag or entry['expires_at'] < time.monotonic():
+            _read_cache_stats['stale' if entry['etag'] != etag else 'expired'] += 1
+            cache_drop(key)
+            return None
+        _read_cache.move_to_end(key)
+        _read_cache_stats['hits'] += 1
+    # Callers add keys to the result, the cached dict itself stays untouched
+    return dict(entry['result'])
+
+def cache_put(key, etag, set_name, result):
+    global _read_cache_bytes
+    # Encoded size as the measure, the Python objects behind it take a small multiple of that
+    size = len(key[1]) + len(json.dumps(result, default=json_default))
+    if size > READ_CACHE_MAX_BYTES // 4:
+        return
+    with _read_cache_lock:
+        if key in _read_cache:
+            cache_drop(key)
+        _read_cache[key] = {
+            'etag': etag,
+            'set_name': set_name,
+            'result': dict(result),
+            'size': size,
+            'expires_at': time.monotonic() + READ_CACHE_TTL_S
+        }
+        _read_cache_bytes += size
+        while _read_cache_bytes > READ_CACHE_MAX_BYTES:
+            cache_drop(next(iter(_read_cache)))
+            _read_cache_stats['evictions'] += 1
+
+def cache_drop(key):
+    # Called with _read_cache_lock held
+    global _read_cache_bytes
+    _read_cache_bytes -= _read_cache.pop(key)['size']
+
+def cache_invalidate(set_name):
+    # Set listings are affected by every write, card reads only by writes to their set
+    with _read_cache_lock:
+        for key in [key for key, entry in _read_cache.items() if entry['set_name'] is None or entry['set_name'] == set_name]:
+            cache_drop(key)
+            _read_cache_stats['invalidations'] += 1
+
+@command()
+def get_cache_stats():
+    with _read_cache_lock:
+        lookups = _read_cache_stats['hits'] + _read_cache_stats['misses'] + _read_cache_stats['stale'] + _read_cache_stats['expired']
+        return {
+            'msg': dict(
+                _read_cache_stats,
+                entries=len(_read_cache),
+                bytes=_read_cache_bytes,
+                max_bytes=READ_CACHE_MAX_BYTES,
+                hit_ratio=round(_read_cache_stats['hits'] / lookups, 3) if lookups else None
+            )
+        }
+
+def make_etag(scope, version):
+    return '"' + hashlib.sha1(f"{scope}:{version}".encode('utf-8')).hexdigest()[:20] + '"'
+
+def flashcards_etag(set_name, page_size=0, cursor=None, fields=None, **_):
+    if not page_size and not cursor and not fields:
+        return make_etag(f"flashcards:{set_name}", store.read_version(set_name))
+    # Every page and projection is its own representation of the set
+    return make_etag(f"flashcards:{set_name}:{page_size}:{cursor}:{fields}", store.read_version(set_name))
+
+def bundle_etag(set_name, render_html=False, **_):
+    return make_etag(f"bundle:{set_name}:{bool(render_html)}", store.read_version(set_name))
+
+def sets_etag(page_size=0, cursor=None, sort=None, order='desc', **_):
+    if not page_size and not cursor and not sort:
+        return make_etag("sets", store.read_version(SETS_VERSION_KEY))
+    # Sorted pages come from eventually consistent indexes that may lag behind the version, so they
+    # get neither an ETag nor a read cache entry
+    return None
+
+def utf8_length(text):
+    return len(text.encode('utf-8'))
+
+class S3MultipartUpload:
+    # Buffers one part at a time, objects smaller than a part are sent with a single put_object
+    def __init__(self, bucket, key, content_type):
+        self.s3 = s3_client()
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= EXPORT_PART_SIZE:
+            self.upload_part()
+
+    def upload_part(self):
+        _deadline.check(WRITE_BUDGET_MS, "the next export part upload")
+        if self.upload_id is None:
+            response = CIRCUITS['s3'].call(self.s3.create_multipart_upload, Bucket=self.bucket, Key=self.key, ContentType=self.content_type)
+            self.upload_id = response['UploadId']
+        number = len(self.parts) + 1
+        response = CIRCUITS['s3'].call(
+            self.s3.upload_part,
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+        logger.debug("Uploaded part %d of %s with %d bytes", number, self.key, len(self.buffer))
+        self.buffer = bytearray()
+
+    def complete(self):
+        if self.upload_id is None:
+            CIRCUITS['s3'].call(self.s3.put_object, Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+            return
+        if self.buffer:
+            self.upload_part()
+        CIRCUITS['s3'].call(
+            self.s3.complete_multipart_upload,
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            try:
+                self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                logger.warning("Error aborting multipart upload of %s: %s", self.key, e)
+
+@command(required=('set_name',), optional={'gzip': False})
+def export_flashcards_to_csv(set_name, gzip=False):
+    logger.info("Exporting flashcards from set %s to CSV file", set_name)
+    filename = f'{set_name}_flashcards_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv' + ('.gz' if gzip else '')
     bucket_name = 'flashcards-ai'
+    upload = S3MultipartUpload(bucket_name, "exports/" + filename, 'application/gzip' if gzip else 'text/csv')
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31) if gzip else None
+    rows = io.StringIO()
+    writer = csv.writer(rows)
+    writer.writerow(['Question', 'Answer'])
+    count = 0
     try:
-        result=s3.upload_file(tmp_filepath, bucket_name, "exports/" + filename)
-        print(f"File {filename} uploaded successfully to S3 bucket {bucket_name}")
-        print(f"Result: {result}")
+        # Rows go straight from the query pages into the upload, so memory is bounded by one part
+        for flashcard in store.query_cards(set_name, fields=['question', 'answer']):
+            writer.writerow([flashcard['question'], flashcard['answer']])
+            count += 1
+            if rows.tell() >= 64 * 1024:
+                data = rows.getvalue().encode('utf-8')
+                rows.seek(0)
+                rows.truncate()
+                upload.write(compressor.compress(data) if compressor else data)
+        if not count:
+            return {'msg': f'No flashcards found for set {set_name}'}
+        data = rows.getvalue().encode('utf-8')
+        upload.write(compressor.compress(data) + compressor.flush() if compressor else data)
+        upload.complete()
+        logger.info("Exported %d flashcards, %d bytes, to %s in S3 bucket %s", count, upload.size, filename, bucket_name)
     except ClientError as e:
+        upload.abort()
         error_msg = f"Error uploading file to S3: {e.response['Error']['Message']}"
-        print(error_msg)
+        logger.error(error_msg)
         return {'error': error_msg}
+    except Exception:
+        upload.abort()
+        raise
     file_url = f'https://{bucket_name}.s3.amazonaws.com/exports/{filename}'
     return {
         'msg': f'Successfully exported flashcards to {filename}',
@@ -181,43 +1688,67 @@ def export_flashcards_to_csv(set_name):
     }
     
 
-def import_flashcards_from_csv(set_name, filename):
-    print(f"Importing flashcards from CSV file {filename} for set {set_name}")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('flashcards')
+@background
+@command(required=('set_name', 'filename'), optional={'start_row': 0}, mutates=True)
+def import_flashcards_from_csv(set_name, filename, start_row=0):
+    logger.info("Importing flashcards from CSV file %s for set %s from row %s", filename, set_name, start_row)
+    start_row = int(start_row)
+    if start_row < 0:
+        raise ValueError("start_row must not be negative")
 
-    s3 = boto3.client('s3')
+    s3 = s3_client()
     try:
-        response = s3.get_object(
+        response = CIRCUITS['s3'].call(
+            s3.get_object,
             Bucket='flashcards-files',
             Key=filename
         )
         file_content = response['Body'].read().decode('utf-8')
-        print(f"Successfully downloaded file {filename} from S3")
+        logger.info("Successfully downloaded file %s from S3", filename)
     except ClientError as e:
         error_msg = f"Error downloading file from S3: {e.response['Error']['Message']}"
-        print(error_msg)
+        logger.error(error_msg)
         return {'error': error_msg}
 
     tmp_filepath = f"/tmp/{filename}"
     pathlib.Path(tmp_filepath).write_text(file_content)
-    print(f"File content written to {tmp_filepath}")
+    logger.debug("File content written to %s", tmp_filepath)
 
+    # Rows are numbered from 0 after the header, and each card keeps its row number so an import can be resumed
+    cards = []
+    skipped = 0
     with open(tmp_filepath, 'r') as file:
         reader = csv.reader(file)
         next(reader)  # Skip header row
-        for row in reader:
+        for row_number, row in enumerate(reader):
+            if row_number < start_row:
+                continue
             if len(row) < 2:
-                print(f"Skipping invalid row: {row}")
+                logger.debug("Skipping invalid row: %s", Truncated(row))
+                skipped += 1
                 continue
-            question, answer = row[0], row[1]
-            print(f"Adding flashcard with question: {question} and answer: {answer[:20]}")
-
-            time.sleep(0.01)
-            id=int(round(datetime.now().timestamp() * 1000))
-            print(f"Adding flashcard with id: {id}")
-            response = table.put_item(Item={'set': set_name, 'id': id, 'question': question, 'answer': answer})
-            print(f"Response: {response}")
+            cards.append((row_number, (row[0], row[1])))
+
+    imported = 0
+    for chunk in chunked(cards, BATCH_WRITE_SIZE):
+        if not _deadline.has(WRITE_BUDGET_MS):
+            next_row = chunk[0][0]
+            logger.warning("Deadline reached after importing %d flashcards into set %s, continuing from row %d", imported, set_name, next_row)
+            if start_background_command('import_flashcards_from_csv', {'set_name': set_name, 'filename': filename, 'start_row': next_row}):
+                return {
+                    'msg': f'Imported {imported} flashcards from {filename} to set {set_name}, the remaining rows are being imported in the background',
+                    'status': 'accepted',
+                    'imported': imported
+                }
+            return {
+                'msg': f'Imported {imported} flashcards from {filename} to set {set_name} before the request deadline, import again with start_row {next_row} for the remaining rows',
+                'partial': True,
+                'imported': imported,
+                'next_row': next_row
+            }
+        store.put_cards(set_name, [card for _, card in chunk])
+        imported += len(chunk)
+    logger.info("Imported %d flashcards into set %s, skipped %d invalid rows", imported, set_name, skipped)
     return {
         'msg': f'Successfully imported flashcards from {filename} to set {set_name}'
     }
@@ -225,10 +1756,12 @@ def import_flashcards_from_csv(set_name, filename):
 
 
 
+@command(required=('question',), idempotent=True, rate='ai')
 def suggest_flashcard_answer(question):
-    print(f"Suggesting flashcard answer for question {question}")
+    logger.info("Suggesting flashcard answer")
+    logger.debug("question: %s", Truncated(question))
 
-    response = client.models.generate_content(
+    response = generate_content(
         model='gemini-2.0-flash',
         contents=question,
         config=types.GenerateContentConfig(
@@ -237,153 +1770,495 @@ def suggest_flashcard_answer(question):
             top_k= 2,
             top_p= 0.5,
             temperature= 0.1,
-            response_mime_type= 'text/plain'
+            response_mime_type= 'text/plain',
+            http_options=gemini_http_options()
         ),
     )
-    print(f"Response: {response}")
+    logger.debug("Response: %s", Truncated(response.text))
     return {
         'msg': response.text
     }
 
+@command(required=('set_name', 'question', 'answer'), mutates=True)
 def add_flashcard(set_name, question, answer):
-    print(f"Adding flashcard to set {set_name} with question {question} and answer {answer}")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('flashcards')
-    response = table.put_item(Item={'set': set_name,'id':int(round(datetime.now().timestamp())), 'question': question, 'answer': answer})
+    logger.info("Adding flashcard to set %s", set_name)
+    logger.debug("question: %s answer: %s", Truncated(question), Truncated(answer))
+    store.put_card(set_name, question, answer)
     return {
         'msg': f'Successfully added flashcard to set {set_name}'
     }
 
+@command(required=('set_name', 'id', 'question', 'answer'), mutates=True)
 def update_flashcard(set_name, id, question, answer):
-    print(f"Updating flashcard {id} in set {set_name} with question {question} and answer {answer}")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('flashcards')
-    response = table.update_item(Key={'set': set_name, 'id': id}, UpdateExpression='set question = :q, answer = :a', ExpressionAttributeValues={':q': question, ':a': answer})
+    logger.info("Updating flashcard %s in set %s", id, set_name)
+    logger.debug("question: %s answer: %s", Truncated(question), Truncated(answer))
+    store.update_card(set_name, id, question, answer)
     return {
         'msg': f'Successfully updated flashcard {id} in set {set_name}'
     }
 
+@command(required=('set_name', 'id'), mutates=True)
 def delete_flashcard(set_name, id):
-    print(f"Deleting flashcard {id} in set {set_name}")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('flashcards')
-    response = table.delete_item(Key={'set': set_name, 'id': id})
+    logger.info("Deleting flashcard %s in set %s", id, set_name)
+    store.delete_card(set_name, id)
     return {
         'msg': f'Successfully deleted flashcard {id} in set {set_name}'
     }
 
-def get_flashcards(set_name):
-    print(f"Getting flashcards for set {set_name}")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('flashcards')
-    response = table.query(
-        KeyConditionExpression='#set = :set_name',
-        ExpressionAttributeNames={
-            '#set': 'set'
-        },
-        ExpressionAttributeValues={
-            ':set_name': set_name
+@command(required=('set_name',), optional={'cursor': 0})
+def get_flashcards_since(set_name, cursor=0):
+    logger.info("Getting flashcards for set %s changed since %s", set_name, cursor)
+    cursor = int(cursor or 0)
+    set_item = store.get_set(set_name)
+    if set_item is None:
+        # Purging a set leaves no tombstones, clients drop all its cards instead
+        return {
+            'msg': {
+                'upserts': [],
+                'deletions': [],
+                'cursor': now_ms() - SYNC_CLOCK_SKEW_MS,
+                'reset': True,
+                'deleted': True
+            }
         }
-    )
-    for item in response['Items']:
-        item['id'] = int(item['id'])
-    print(f"Items: {response['Items']}")
+    # Tombstones older than the cursor may have expired, and a restore brings back cards with their
+    # old updated_at while dropping newer ones without tombstones, so such clients start over
+    if not cursor or cursor < now_ms() - TOMBSTONE_TTL_S * 1000 or cursor <= set_item.get('restored_at', 0):
+        # Full sync, which also covers cards written before updated_at was recorded
+        upserts = list(store.query_cards(set_name))
+        return {
+            'msg': {
+                'upserts': upserts,
+                'deletions': [],
+                'cursor': now_ms() - SYNC_CLOCK_SKEW_MS,
+                'reset': True
+            }
+        }
+
+    since = cursor - SYNC_CLOCK_SKEW_MS
+    upserts = list(store.query_cards(set_name, since=since))
+    deletions = list(store.deleted_since(set_name, since))
+    new_cursor = max([cursor] + [item['updated_at'] for item in upserts + deletions])
+    logger.info("Found %d changed and %d deleted flashcards in set %s", len(upserts), len(deletions), set_name)
     return {
-        'msg': response['Items']
+        'msg': {
+            'upserts': upserts,
+            'deletions': [item['id'] for item in deletions],
+            'cursor': new_cursor,
+            'reset': False
+        }
     }
 
+def iter_flashcards(set_name, fields=None, **_):
+    # Streaming already sends cards as they are read, so it always covers the whole set
+    if store.is_set_deleting(set_name):
+        return iter(())
+    return store.query_cards(set_name, fields=fields)
+
+@command(required=('set_name',), optional={'page_size': 0, 'cursor': None, 'fields': None}, etag=flashcards_etag, stream=iter_flashcards, cache=True, columnar=True)
+def get_flashcards(set_name, page_size=0, cursor=None, fields=None):
+    logger.info("Getting flashcards for set %s", set_name)
+    if page_size or cursor:
+        page_size = int(page_size or GET_FLASHCARDS_MAX_PAGE_SIZE)
+        if not 0 < page_size <= GET_FLASHCARDS_MAX_PAGE_SIZE:
+            raise ValueError(f"page_size must be between 1 and {GET_FLASHCARDS_MAX_PAGE_SIZE}")
+        if store.is_set_deleting(set_name):
+            return {'msg': [], 'cursor': None}
+        items, next_cursor = store.query_cards_page(set_name, page_size, cursor, fields)
+        logger.info("Found %d flashcards in page of set %s, more: %s", len(items), set_name, next_cursor is not None)
+        return {
+            'msg': items,
+            'cursor': next_cursor
+        }
+    items = list(iter_flashcards(set_name, fields))
+    logger.info("Found %d flashcards in set %s", len(items), set_name)
+    logger.debug("Items: %s", Truncated(items))
+    return {
+        'msg': items
+    }
+
+@command(required=('set_name', 'id'), optional={'fields': None})
+def get_flashcard(set_name, id, fields=None):
+    logger.info("Getting flashcard %s in set %s", id, set_name)
+    item = store.get_card(set_name, int(id), fields)
+    if item is None or store.is_set_deleting(set_name):
+        return {'error': f'Flashcard {id} not found in set {set_name}'}
+    return {
+        'msg': item
+    }
+
+@command(required=('set_name',), mutates=True)
 def delete_set_with_flashcards(set_name):
-    print(f"Deleting set {set_name} and all its flashcards")
-    dynamodb = boto3.resource('dynamodb')
+    logger.info("Deleting set %s and all its flashcards", set_name)
     
-    # Delete all flashcards in the set
-    flashcards_table = dynamodb.Table('flashcards')
-    response = flashcards_table.query(
-        KeyConditionExpression='#set = :set_name',
-        ExpressionAttributeNames={
-            '#set': 'set'
-        },
-        ExpressionAttributeValues={
-            ':set_name': set_name
+    # Hide the set right away, the flashcards are purged afterwards
+    store.mark_set_deleting(set_name)
+    if start_background_command('purge_set', {'set_name': set_name}):
+        return {
+            'msg': f'Deleted set {set_name}, its flashcards are being purged in the background',
+            'status': 'accepted'
         }
-    )
-    
-    # Delete each flashcard
-    for item in response['Items']:
-        flashcards_table.delete_item(
-            Key={
-                'set': set_name,
-                'id': item['id']
-            }
-        )
-    
-    # Delete the set itself
-    sets_table = dynamodb.Table('sets')
-    sets_table.delete_item(
-        Key={
-            'name': set_name
+    result = purge_set(set_name)
+    if result.get('partial'):
+        return result
+    return {
+        'msg': f'Successfully deleted set {set_name} and all its flashcards'
+    }
+
+@background
+def purge_set(set_name):
+    logger.info("Purging flashcards of deleted set %s", set_name)
+    deleted = 0
+    with ThreadPoolExecutor(max_workers=PURGE_MAX_WORKERS) as executor:
+        while True:
+            # Cards written while the purge ran show up in the next pass, the set is only removed once a pass finds none
+            ids = store.query_cards(set_name, ProjectionExpression='#id', ExpressionAttributeNames={'#id': 'id'})
+            pass_deleted = 0
+            for page in chunked((item['id'] for item in ids), PURGE_PAGE_SIZE):
+                if not _deadline.has(PURGE_RESERVE_MS):
+                    # Pick up where this invocation stopped with a fresh time budget
+                    if start_background_command('purge_set', {'set_name': set_name}):
+                        logger.warning("Continuing purge of set %s in a new invocation after %d flashcards", set_name, deleted)
+                        return {'msg': f'Purged {deleted} flashcards of set {set_name}, continuing in the background', 'partial': True}
+                    return {'msg': f'Purged {deleted} flashcards of set {set_name} before the deadline, delete the set again to finish', 'partial': True}
+                futures = [executor.submit(store.delete_cards, set_name, batch) for batch in chunked(page, BATCH_WRITE_SIZE)]
+                for future in futures:
+                    future.result()
+                pass_deleted += len(page)
+                deleted += len(page)
+                store.record_purge_progress(set_name, len(page), 'running')
+                logger.info("Purged %d flashcards of set %s so far", deleted, set_name)
+            if not pass_deleted:
+                break
+    store.delete_offloaded_answers(set_name)
+    store.delete_set(set_name)
+    logger.info("Purged set %s with %d flashcards", set_name, deleted)
+    return {'msg': f'Purged set {set_name} and {deleted} flashcards'}
+
+@command(required=('set_name',))
+def get_set_deletion_progress(set_name):
+    progress = store.purge_progress(set_name)
+    if progress is None:
+        return {'msg': {'status': 'done'}}
+    if 'deleting' not in progress:
+        return {'error': f'Set {set_name} is not being deleted'}
+    return {
+        'msg': {
+            'status': progress.get('purge_status', 'pending'),
+            'deleted': progress.get('purge_deleted', 0),
+            'since': progress['deleting']
         }
+    }
+
+def attribute_to_json(value):
+    # DynamoDB JSON as the low-level client returns it, with binary values base64 encoded
+    (kind, raw), = value.items()
+    if kind == 'B':
+        return {'B': base64.b64encode(raw).decode('ascii')}
+    if kind == 'BS':
+        return {'BS': [base64.b64encode(member).decode('ascii') for member in raw]}
+    if kind == 'M':
+        return {'M': {name: attribute_to_json(member) for name, member in raw.items()}}
+    if kind == 'L':
+        return {'L': [attribute_to_json(member) for member in raw]}
+    return value
+
+def attribute_from_json(value):
+    (kind, raw), = value.items()
+    if kind == 'B':
+        return {'B': base64.b64decode(raw)}
+    if kind == 'BS':
+        return {'BS': [base64.b64decode(member) for member in raw]}
+    if kind == 'M':
+        return {'M': {name: attribute_from_json(member) for name, member in raw.items()}}
+    if kind == 'L':
+        return {'L': [attribute_from_json(member) for member in raw]}
+    return value
+
+def with_offloaded_answer(item):
+    # Offloaded answers are copied into the shard, as stored (compressed), so a restore does not depend on them
+    if 'answer_ref' not in item:
+        return item
+    bucket, key = item['answer_ref']['S'].split('/', 1)
+    body = CIRCUITS['s3'].call(s3_client().get_object, Bucket=bucket, Key=key)['Body'].read()
+    return dict(item, **{BACKUP_ANSWER_OBJECT: {'B': body}})
+
+def restore_offloaded_answer(item):
+    body = item.pop(BACKUP_ANSWER_OBJECT, None)
+    if body is not None:
+        bucket, key = item['answer_ref']['S'].split('/', 1)
+        CIRCUITS['s3'].call(s3_client().put_object, Bucket=bucket, Key=key, Body=body['B'], ContentEncoding=item['answer_codec']['S'])
+    return item
+
+def restore_version(item):
+    # The backed up version was already handed out for other content, so the restored item keeps the
+    # current one if that is higher, and run_restore bumps it past both once all shards are written
+    current = store.read_version(item['name']['S'])
+    item['version'] = {'N': str(max(current, int(item.get('version', {}).get('N', 0))))}
+    return item
+
+def backup_segment(backup_id, table_name, segment, total_segments):
+    key = f"{BACKUP_PREFIX}{backup_id}/{table_name}/segment-{segment:04d}.ndjson.gz"
+    upload = S3MultipartUpload(BACKUP_BUCKET, key, 'application/x-ndjson')
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    dynamodb = store.dynamodb
+    kwargs = {}
+    count = 0
+    try:
+        while True:
+            response = dynamodb.scan(TableName=table_name, Segment=segment, TotalSegments=total_segments, **kwargs)
+            lines = ''.join(
+                json.dumps({name: attribute_to_json(value) for name, value in with_offloaded_answer(item).items()}, separators=(',', ':')) + '\n'
+                for item in response['Items']
+            )
+            upload.write(compressor.compress(lines.encode('utf-8')))
+            count += len(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        upload.write(compressor.flush())
+        upload.complete()
+    except Exception:
+        upload.abort()
+        raise
+    logger.info("Backed up %d items of %s segment %d to %s", count, table_name, segment, key)
+    return {'table': table_name, 'key': key, 'items': count, 'bytes': upload.size}
+
+def new_backup_id():
+    return datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+
+# Backup and restore are not API commands, anyone able to call the API could roll back all data.
+# They run from the CLI, or as background commands through a direct, IAM authorised invocation.
+@background
+def run_backup(backup_id, segments):
+    if not 0 < segments <= BACKUP_MAX_SEGMENTS:
+        raise ValueError(f"segments must be between 1 and {BACKUP_MAX_SEGMENTS}")
+    started = time.monotonic()
+    tables = (store.flashcards_table, store.sets_table)
+    # A segmented scan is not a point-in-time snapshot, writes made while it runs may or may not be included
+    with ThreadPoolExecutor(max_workers=BACKUP_MAX_WORKERS) as executor:
+        futures = [executor.submit(backup_segment, backup_id, table_name, segment, segments)
+                   for table_name in tables for segment in range(segments)]
+        shards = [future.result() for future in futures]
+    manifest = {
+        'backup_id': backup_id,
+        'created_at': datetime.now().isoformat(),
+        'segments': segments,
+        'tables': {table_name: sum(shard['items'] for shard in shards if shard['table'] == table_name) for table_name in tables},
+        'shards': shards
+    }
+    CIRCUITS['s3'].call(
+        s3_client().put_object,
+        Bucket=BACKUP_BUCKET,
+        Key=f"{BACKUP_PREFIX}{backup_id}/manifest.json",
+        Body=json.dumps(manifest, indent=2).encode('utf-8'),
+        ContentType='application/json'
     )
-    
+    logger.info("Backup %s of %s finished in %d ms", backup_id, manifest['tables'], (time.monotonic() - started) * 1000)
+    return {'msg': f"Backed up {', '.join(f'{count} items of {name}' for name, count in manifest['tables'].items())}", 'backup_id': backup_id, 'manifest': manifest}
+
+def restore_shard(shard):
+    response = CIRCUITS['s3'].call(s3_client().get_object, Bucket=BACKUP_BUCKET, Key=shard['key'])
+    restored = 0
+    set_names = set()
+    with gzip.GzipFile(fileobj=response['Body']) as lines:
+        items = ({name: attribute_from_json(value) for name, value in json.loads(line).items()} for line in lines)
+        # Each worker has at most one BatchWriteItem in flight and backs off on unprocessed items,
+        # so the pool size bounds the write pressure on the table
+        for batch in chunked(items, BATCH_WRITE_SIZE):
+            if shard['table'] == store.sets_table:
+                for item in batch:
+                    restore_version(item)
+            store.batch_write(shard['table'], [{'PutRequest': {'Item': restore_offloaded_answer(item)}} for item in batch])
+            restored += len(batch)
+            if shard['table'] == store.sets_table:
+                set_names.update(item['name']['S'] for item in batch)
+    logger.info("Restored %d items of %s from %s", restored, shard['table'], shard['key'])
+    return restored, set_names
+
+@background
+def run_restore(backup_id, workers):
+    if not 0 < workers <= BACKUP_MAX_SEGMENTS:
+        raise ValueError(f"workers must be between 1 and {BACKUP_MAX_SEGMENTS}")
+    if not re.fullmatch(r'[0-9A-Za-z-]+', backup_id):
+        raise ValueError(f"Invalid backup id: {backup_id}")
+    started = time.monotonic()
+    try:
+        response = CIRCUITS['s3'].call(s3_client().get_object, Bucket=BACKUP_BUCKET, Key=f"{BACKUP_PREFIX}{backup_id}/manifest.json")
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
+        return {'error': f'Backup {backup_id} not found'}
+    manifest = json.loads(response['Body'].read())
+    restored = {}
+    set_names = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(shard['table'], executor.submit(restore_shard, shard)) for shard in manifest['shards']]
+        for table_name, future in futures:
+            count, names = future.result()
+            restored[table_name] = restored.get(table_name, 0) + count
+            set_names |= names
+    # Versions are bumped past anything handed out before, so no ETag or cache entry from before the restore matches
+    for set_name in set_names - {SETS_VERSION_KEY}:
+        store.mark_set_restored(set_name)
+        store.bump_version(set_name)
+        cache_invalidate(set_name)
+    store.bump_version(None)
+    cache_invalidate(None)
+    logger.info("Restore of backup %s finished in %d ms: %s", backup_id, (time.monotonic() - started) * 1000, restored)
+    return {'msg': f"Restored {', '.join(f'{count} items of {name}' for name, count in restored.items())} from backup {backup_id}", 'restored': restored}
+
+# The js-default preset is what window.markdownit() uses in the web UI: tables and strikethrough, raw HTML escaped.
+# markdown_it is imported on first use, only bundles with render_html need it
+_markdown = None
+
+def render_markdown(text):
+    # None when markdown_it is missing, the client then renders the answer itself
+    global _markdown
+    if _markdown is None:
+        try:
+            from markdown_it import MarkdownIt
+            _markdown = MarkdownIt('js-default')
+        except ImportError:
+            logger.warning("markdown_it is not installed, answers are not rendered")
+            _markdown = False
+    if _markdown is False:
+        return None
+    return _markdown.render(text)
+
+@command(required=('set_name',), optional={'render_html': False}, etag=bundle_etag, cache_control=BUNDLE_CACHE_CONTROL, cache=True)
+def get_set_bundle(set_name, render_html=False):
+    logger.info("Getting bundle for set %s", set_name)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        set_future = executor.submit(store.get_set, set_name)
+        flashcards_future = executor.submit(get_flashcards, set_name)
+        set_item = set_future.result()
+        flashcards = flashcards_future.result()['msg']
+    if set_item is None:
+        return {'error': f'Set {set_name} not found'}
+    if render_html:
+        for card in flashcards:
+            answer_html = render_markdown(card['answer'])
+            if answer_html is not None:
+                card['answer_html'] = answer_html
     return {
-        'msg': f'Successfully deleted set {set_name} and all its flashcards'
+        'msg': {
+            'set': set_item,
+            'flashcards': flashcards
+        }
     }
 
+@command(optional={'page_size': 0, 'cursor': None, 'sort': None, 'order': 'desc'}, etag=sets_etag, cache=True, columnar=True)
+def get_sets(page_size=0, cursor=None, sort=None, order='desc'):
+    logger.info("Getting sets")
+    if sort and sort not in SETS_SORT_INDEXES:
+        raise ValueError(f"sort must be one of {', '.join(SETS_SORT_INDEXES)}")
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be 'asc' or 'desc'")
+    if not page_size and not cursor and not sort:
+        # Unpaginated listing, which also includes sets that predate the sort indexes
+        return {
+            'msg': list(store.scan_sets())
+        }
+    sort = sort or 'created_at'
+    page_size = int(page_size or GET_SETS_DEFAULT_PAGE_SIZE)
+    if not 0 < page_size <= GET_SETS_MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {GET_SETS_MAX_PAGE_SIZE}")
+    items, next_cursor = store.query_sets_page(sort, order == 'asc', page_size, cursor)
+    logger.info("Found %d sets sorted by %s, more: %s", len(items), sort, next_cursor is not None)
+    return {
+        'msg': items,
+        'cursor': next_cursor
+    }
 
-def get_sets():
-    print(f"Getting sets")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('sets')
-    response = table.scan()
+@command(required=('commands',))
+def batch(commands):
+    logger.info("Running batch of %d commands", len(commands) if isinstance(commands, list) else 0)
+    if not isinstance(commands, list) or not commands:
+        raise ValueError("'commands' must be a non-empty list")
+    if len(commands) > BATCH_MAX_COMMANDS:
+        raise ValueError(f"Batch is limited to {BATCH_MAX_COMMANDS} commands")
+
+    results = [None] * len(commands)
+    # Consecutive read-only commands run concurrently, a mutating command waits
+    # for everything before it and runs on its own so ordering is preserved
+    pending = []
+    with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as executor:
+        for index, sub_command in enumerate(commands):
+            name = sub_command.get('command') if isinstance(sub_command, dict) else None
+            entry = COMMANDS.get(name)
+            if entry is not None and entry['mutates']:
+                for pending_index, future in pending:
+                    results[pending_index] = future.result()
+                pending = []
+                results[index] = run_batch_command(sub_command)
+            else:
+                pending.append((index, executor.submit(run_batch_command, sub_command)))
+        for pending_index, future in pending:
+            results[pending_index] = future.result()
     return {
-        'msg': response['Items']
+        'msg': results
     }
 
+def run_batch_command(sub_command):
+    if not isinstance(sub_command, dict) or 'command' not in sub_command:
+        return {'command': None, 'statusCode': 400, 'body': {'error': "Missing required 'command' field in batch entry"}}
+    command = sub_command['command']
+    try:
+        if command == 'batch':
+            raise ValueError("Nested batch commands are not supported")
+        result = command_dispatch(command, sub_command.get('content', ""), sub_command.get('if_none_match'))
+        status = 200 if 'msg' in result else 400
+    except NotModified as e:
+        result = {'etag': e.etag}
+        status = 304
+    except CommandInProgress as e:
+        result = {'error': str(e), 'status': 'in_progress'}
+        status = 409
+    except IdempotencyKeyReused as e:
+        result = {'error': str(e)}
+        status = 422
+    except CircuitOpen as e:
+        result = {'error': str(e)}
+        status = 503
+    except ValueError as e:
+        result = {'error': str(e)}
+        status = 400
+    except Exception as e:
+        logger.exception("Error in batch command %s: %s", command, e)
+        result = {'error': f"Internal server error: {str(e)}"}
+        status = 500
+    return {'command': command, 'statusCode': status, 'body': result}
+
+@command(required=('set_name',), mutates=True, rate='ai')
 def suggest_flashcards(set_name):
-    print(f"Suggesting new flashcards for set {set_name}")
-    dynamodb = boto3.resource('dynamodb')
+    logger.info("Suggesting new flashcards for set %s", set_name)
     
     # Retrieve existing flashcards in the set
-    flashcards_table = dynamodb.Table('flashcards')
-    response = flashcards_table.query(
-        KeyConditionExpression='#set = :set_name',
-        ExpressionAttributeNames={
-            '#set': 'set'
-        },
-        ExpressionAttributeValues={
-            ':set_name': set_name
-        }
-    )
-    
-    existing_flashcards = response['Items']
+    existing_flashcards = list(store.query_cards(set_name, fields=['question']))
     if not existing_flashcards:
         return {'msg': 'No existing flashcards found to base suggestions on.'}
     
     existing_flashcards_text = " ".join([f"Question: {card['question']}" for card in existing_flashcards])
     
     # Retrieve the set details to check if it has text content
-    sets_table = dynamodb.Table('sets')
-    set_response = sets_table.get_item(
-        Key={
-            'name': set_name
-        }
-    )
+    set_item = store.get_set(set_name)
     
     # Initialize text variable
     text = ""
     
     # If content_path exists, try to load the text from S3
-    if 'Item' in set_response and 'content_path' in set_response['Item'] and set_response['Item']['content_path'].strip():
-        content_path = set_response['Item']['content_path']
+    if set_item and set_item.get('content_path', '').strip():
+        content_path = set_item['content_path']
         bucket_name, key = content_path.split('/', 1)
         
         try:
-            s3 = boto3.client('s3')
-            s3_response = s3.get_object(Bucket=bucket_name, Key=key)
+            s3 = s3_client()
+            s3_response = CIRCUITS['s3'].call(s3.get_object, Bucket=bucket_name, Key=key)
             text = s3_response['Body'].read().decode('utf-8')
-            print(f"Successfully loaded text from S3: {content_path}")
+            logger.info("Successfully loaded text from S3: %s", content_path)
         except Exception as e:
-            print(f"Error loading text from S3: {e}")
+            logger.warning("Error loading text from S3: %s", e)
             # Continue without the file content
     
     # Prepare the prompt based on available information
@@ -392,9 +2267,9 @@ def suggest_flashcards(set_name):
     else:
         question = f"Can you suggest more flashcards based on these existing flashcards: {existing_flashcards_text}? Create new flashcards that expand on the topics covered in the existing ones."
     
-    print(f"Generating flashcards with prompt: {question[:100]}...")
+    logger.debug("Generating flashcards with prompt: %s", Truncated(question, 100))
     
-    response = client.models.generate_content(
+    response = generate_content(
         model='gemini-2.0-flash',
         contents=[question],
         config=types.GenerateContentConfig(
@@ -403,11 +2278,12 @@ def suggest_flashcards(set_name):
             top_k=2,
             top_p=0.5,
             temperature=0.1,
-            response_mime_type='text/plain'
+            response_mime_type='text/plain',
+            http_options=gemini_http_options()
         ),
     )
 
-    print(f"Response received, parsing flashcards...")
+    logger.debug("Response received, parsing flashcards")
     
     # Parse suggested flashcards from response text
     suggested_flashcards = []
@@ -423,52 +2299,47 @@ def suggest_flashcards(set_name):
                 'answer': answer_match.group(1).strip()
             })
     
-    print(f"Found {len(suggested_flashcards)} suggested flashcards")
+    logger.info("Found %d suggested flashcards", len(suggested_flashcards))
     
     # Persist new flashcards in the set
-    table = dynamodb.Table('flashcards')
-    for flashcard in suggested_flashcards:
-        try:
-            table.put_item(
-                Item={
-                    'set': set_name,
-                    'id': int(round(datetime.now().timestamp())),
-                    'question': flashcard['question'],
-                    'answer': flashcard['answer']
-                }
-            )
-        except Exception as e:
-            print(f"Error persisting flashcard: {e}")
-            return {'msg': f'Error persisting flashcards: {str(e)}'}
+    try:
+        store.put_cards(set_name, [(flashcard['question'], flashcard['answer']) for flashcard in suggested_flashcards])
+    except Exception as e:
+        logger.error("Error persisting flashcards: %s", e)
+        return {'msg': f'Error persisting flashcards: {str(e)}'}
     
     return {
         'msg': f"Successfully added {len(suggested_flashcards)} new flashcards"
     }
 
+@background
 def create_flashcards_from_file(set_name, filename):
-    print(f"Creating flashcards from file {filename} for set {set_name}")
+    logger.info("Creating flashcards from file %s for set %s", filename, set_name)
     # Load file from S3 bucket
-    s3 = boto3.client('s3')
+    s3 = s3_client()
     try:
-        response = s3.get_object(
+        response = CIRCUITS['s3'].call(
+            s3.get_object,
             Bucket='flashcards-files',
             Key=filename
         )
         file_content = response['Body'].read()
-        print(f"Successfully loaded file {filename} from S3")
+        logger.info("Successfully loaded file %s from S3", filename)
     except ClientError as e:
         error_msg = f"Error loading file from S3: {e.response['Error']['Message']}"
-        print(error_msg)
+        logger.error(error_msg)
         return {'error': error_msg}
 
     file_content_str = file_content.decode('utf-8')
     tmp_filepath = f"/tmp/{filename}"
     pathlib.Path(tmp_filepath).write_text(file_content_str)
-    print(f"File content written to {tmp_filepath}")
-    my_file = client.files.upload(file=tmp_filepath)
-    print(f"File uploaded to Gemini: {my_file}")
+    logger.debug("File content written to %s", tmp_filepath)
+    # The upload call has no per-request timeout, so only start it with enough budget for the generation too
+    _deadline.check(GEMINI_MIN_TIMEOUT_MS + GEMINI_RESERVE_MS, "the Gemini file upload")
+    my_file = CIRCUITS['gemini'].call(require_gemini_client().files.upload, file=tmp_filepath)
+    logger.debug("File uploaded to Gemini: %s", Truncated(my_file))
     question = f"Can you prepare flashcards based on this file: {filename}?"
-    response = client.models.generate_content(
+    response = generate_content(
         model='gemini-2.0-flash',
         contents=[question,my_file],
         config=types.GenerateContentConfig(
@@ -477,13 +2348,13 @@ def create_flashcards_from_file(set_name, filename):
             top_k= 2,
             top_p= 0.5,
             temperature= 0.1,
-            response_mime_type= 'text/plain'
+            response_mime_type= 'text/plain',
+            http_options=gemini_http_options()
         ),
     )
 
 
-    print(f"Response text: {response.text}")
-    print("\n"*5)
+    logger.debug("Response text: %s", Truncated(response.text))
     # Parse flashcards from response text
     flashcards = []
     flashcard_parts = []
@@ -504,17 +2375,27 @@ def create_flashcards_from_file(set_name, filename):
             answer = answer_match.group(1).strip()
             flashcard_parts = [question, answer]
             flashcards.append(flashcard_parts)
-    print(f"Flashcards: {len(flashcards)}")
-    for flashcard in flashcards:
-        add_flashcard(set_name, flashcard[0], flashcard[1])
+    logger.info("Parsed %d flashcards from file %s", len(flashcards), filename)
+    added = 0
+    for chunk in chunked(flashcards, BATCH_WRITE_SIZE):
+        if not _deadline.has(WRITE_BUDGET_MS):
+            logger.warning("Deadline reached after adding %d of %d flashcards to set %s", added, len(flashcards), set_name)
+            return {'msg': f'Added {added} of {len(flashcards)} flashcards to set {set_name}', 'partial': True}
+        store.put_cards(set_name, chunk)
+        added += len(chunk)
+    return {'msg': f'Added {added} flashcards to set {set_name}'}
+
 
 
+def create_set_rate(content):
+    # Only sets created from a file call the model
+    return 'ai' if content.get('filename') else 'write'
 
+@command(required=('name', 'description'), optional={'filename': ''}, mutates=True, rate=create_set_rate)
 def create_set(name, description="", filename=""):
     # Create a DynamoDB resource
-    print(f"Creating set with name: {name} and description: {description} and filename: {filename}")
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table('sets')
+    logger.info("Creating set %s with filename: %s", name, filename)
+    logger.debug("description: %s", Truncated(description))
     
     try:
         # Create new set item
@@ -529,48 +2410,62 @@ def create_set(name, description="", filename=""):
             # Store the S3 path to the file content
             item['content_path'] = f"flashcards-files/{filename}"
             
-        response = table.put_item(
-            Item=item,
-            ConditionExpression="attribute_not_exists(#n)",
-            ExpressionAttributeNames={
-                "#n": "name"
-            }
-        )
+        store.put_new_set(item)
         
         if filename and len(filename) > 0:
-            create_flashcards_from_file(name, filename)
+            if not _deadline.has(FILE_GENERATION_BUDGET_MS) and start_background_command('create_flashcards_from_file', {'set_name': name, 'filename': filename}):
+                return {
+                    'msg': f'Created set {name}, flashcards from {filename} are being generated in the background',
+                    'status': 'accepted'
+                }
+            result = create_flashcards_from_file(name, filename)
+            if 'error' in result:
+                return result
+            return {
+                'msg': f'Successfully created set {name} with description {description}. {result["msg"]}'
+            }
 
         return {
             'msg': f'Successfully created set {name} with description {description}'
         }
     except ClientError as e:
         error_msg = f"Error creating set: {e.response['Error']['Message']}"
-        print(error_msg)
+        logger.error(error_msg)
         return {'error': error_msg}
 
 client = None
 # Cache for storing the API key
 _gemini_apikey_cache = None
+_gemini_apikey_loaded_at = 0.0
 
 MODEL_NAME="gemini-2.0-flash"
 
 
-def set_gemini_apikey():
-    global _gemini_apikey_cache
-    if _gemini_apikey_cache is None:
-        _gemini_apikey_cache=json.loads(load_gemini_apikey())['GEMINI_API_KEY']
+def set_gemini_apikey(force=False):
+    global _gemini_apikey_cache, _gemini_apikey_loaded_at, client
+    if not force and _gemini_apikey_cache is not None and time.monotonic() - _gemini_apikey_loaded_at < GEMINI_APIKEY_TTL_S:
+        return
+    try:
+        apikey = json.loads(CIRCUITS['secretsmanager'].call(load_gemini_apikey))['GEMINI_API_KEY']
+    except Exception as e:
+        if _gemini_apikey_cache is None:
+            raise
+        logger.warning("Refreshing the Gemini API key failed, keeping the cached one: %s", e)
+        _gemini_apikey_loaded_at = time.monotonic()
+        return
+    if apikey != _gemini_apikey_cache:
+        # Rotated key, the client is rebuilt on next use
+        client = None
+    _gemini_apikey_cache = apikey
+    _gemini_apikey_loaded_at = time.monotonic()
 
 def load_gemini_apikey():
-    print("Loading Gemini API key")
+    logger.info("Loading Gemini API key")
     secret_name = "gemini_apikey"
     region_name = "eu-central-1"
 
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    # Shared Secrets Manager client from the pool
+    client = aws_client('secretsmanager', region_name=region_name)
 
     try:
         get_secret_value_response = client.get_secret_value(
@@ -585,7 +2480,288 @@ def load_gemini_apikey():
 
     # Your code goes here.
 
+class FlashcardsRequestHandler(BaseHTTPRequestHandler):
+    # Self-hosted entry point. Requests are translated into Lambda proxy events, except
+    # NDJSON requests for streamable commands, which are written as chunks while the query pages in.
+    protocol_version = 'HTTP/1.1'
+
+    def do_OPTIONS(self):
+        self.respond(lambda_handler(self.to_event('OPTIONS'), None))
+
+    def do_POST(self):
+        global _deadline
+        event = self.to_event('POST')
+        try:
+            json_body = decode_request_body(event)
+        except ValueError:
+            json_body = None
+        command = json_body.get('command') if isinstance(json_body, dict) else None
+        if not is_streaming_request(command, event):
+            self.respond(lambda_handler(event, None))
+            return
+
+        _deadline = Deadline(REQUEST_TIMEOUT_MS)
+        content = json_body.get('content', "")
+        configure_invocation_logging(command)
+        try:
+            enforce_rate_limits(caller_id(event), command, content)
+            lines = stream_command(command, content)
+            # Fetch the first page before committing to a 200 so that errors still get a status code
+            first_line = next(lines, None)
+        except Exception as e:
+            self.respond(error_response(e, command, event))
+            return
+
+        self.send_response(200)
+        for key, value in CORS_HEADERS.items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', NDJSON_CONTENT_TYPE)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        count = 0
+        try:
+            if first_line is not None:
+                self.write_chunk(first_line)
+                count += 1
+            for line in lines:
+                self.write_chunk(line)
+                count += 1
+        except Exception as e:
+            logger.error("Error while streaming %s after %d items: %s", command, count, e, exc_info=e)
+            self.write_chunk(json.dumps({'error': f"Internal server error: {str(e)}"}) + '\n')
+        self.wfile.write(b'0\r\n\r\n')
+        logger.info("Command %s streamed %d items", command, count)
+
+    def to_event(self, method):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        return {
+            'httpMethod': method,
+            'path': self.path,
+            'headers': dict(self.headers),
+            'body': base64.b64encode(body).decode('ascii'),
+            'isBase64Encoded': True,
+            'requestContext': {'identity': {'sourceIp': self.client_address[0]}}
+        }
+
+    def respond(self, response):
+        body = response.get('body') or ''
+        body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+        self.send_response(response['statusCode'])
+        for key, value in response.get('headers', {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+
+def serve(host, port):
+    # Single threaded on purpose: like a Lambda container, one request is handled at a time
+    server = HTTPServer((host, port), FlashcardsRequestHandler)
+    logger.info("Serving on http://%s:%d", host, port)
+    server.serve_forever()
+
+def prime_container(targets):
+    # Runs during the init phase, which is not billed against the request deadline
+    started = time.monotonic()
+    try:
+        if 'aws' in targets:
+            dynamodb = aws_client('dynamodb')
+            dynamodb.describe_table(TableName=store.flashcards_table)
+            dynamodb.describe_table(TableName=store.sets_table)
+            s3_client()
+        if 'gemini' in targets:
+            init_gemini_client()
+    except Exception as e:
+        logger.warning("Priming %s failed: %s", ','.join(targets), e)
+    logger.info("Primed %s in %d ms", ','.join(targets), (time.monotonic() - started) * 1000)
+
+def import_time_report(top, ai=False):
+    code = 'import main' + ('; main.genai.Client' if ai else '')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=pathlib.Path(__file__).resolve().parent,
+        env=dict(os.environ, PRIME_ON_INIT='', LOG_LEVEL='WARNING'),
+        capture_output=True,
+        text=True
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)', line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((len(indent), name.split('.')[0], int(self_us), int(cumulative_us)))
+    packages = {}
+    parents = []
+    # Imports are printed children first, reversed every parent comes before its children
+    for depth, package, self_us, cumulative_us in reversed(entries):
+        while parents and parents[-1][0] >= depth:
+            parents.pop()
+        entry = packages.setdefault(package, {'self_us': 0, 'cumulative_us': 0, 'modules': 0})
+        entry['self_us'] += self_us
+        entry['modules'] += 1
+        if not parents or parents[-1][1] != package:
+            # Only the outermost import of a package, its submodules are already included
+            entry['cumulative_us'] += cumulative_us
+        parents.append((depth, package))
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else "Import failed", file=sys.stderr)
+    total_us = sum(entry['self_us'] for entry in packages.values())
+    print(f"{'package':<30} {'modules':>8} {'self ms':>10} {'cumulative ms':>14}")
+    for package, entry in sorted(packages.items(), key=lambda item: -item[1]['self_us'])[:top]:
+        print(f"{package:<30} {entry['modules']:>8} {entry['self_us'] / 1000:>10.1f} {entry['cumulative_us'] / 1000:>14.1f}")
+    print(f"{'total':<30} {sum(entry['modules'] for entry in packages.values()):>8} {total_us / 1000:>10.1f}")
+
+if PRIME_ON_INIT:
+    prime_container(PRIME_ON_INIT)
+
+def benchmark_deserialization(cards, repeats):
+    raw_items = [{
+        'set': {'S': 'benchmark'},
+        'id': {'N': str(1700000000000 + i)},
+        'question': {'S': f'What is question number {i}?'},
+        'answer': {'S': f'This is the **answer** to question {i}. ' * 4},
+        'updated_at': {'N': str(1700000000000 + i)}
+    } for i in range(cards)]
+
+    def resource_layer():
+        # What boto3.resource does for every item, plus the id conversion get_flashcards used to do
+        items = [{name: _boto3_deserializer.deserialize(value) for name, value in item.items()} for item in raw_items]
+        for item in items:
+            item['id'] = int(item['id'])
+        return json.dumps(items, default=json_default)
+
+    def low_level():
+        return json.dumps([deserialize_item(item) for item in raw_items], default=json_default)
+
+    assert json.loads(resource_layer()) == json.loads(low_level())
+    results = {}
+    for name, path in (('resource', resource_layer), ('low-level', low_level)):
+        timings = []
+        for _ in range(repeats):
+            started = time.process_time()
+            path()
+            timings.append(time.process_time() - started)
+        results[name] = min(timings)
+        print(f"{name:<10} {results[name] * 1000:>9.1f} ms {results[name] * 1e6 / cards:>8.2f} us/card")
+    print(f"speedup    {results['resource'] / results['low-level']:>9.2f}x over {cards} cards")
+
+def sample_answer(rng, target_bytes):
+    # Shaped like the model's markdown answers: headings, prose, bullet lists and code blocks
+    words = ('the', 'function', 'returns', 'a', 'value', 'when', 'list', 'is', 'empty', 'and', 'each', 'element', 'of',
+        'memory', 'lambda', 'request', 'table', 'index', 'query', 'python', 'class', 'method', 'called', 'with', 'object',
+        'binary', 'search', 'tree', 'height', 'balanced', 'node', 'pointer', 'hash', 'collision', 'bucket', 'thread', 'lock',
+        'deadlock', 'process', 'kernel', 'cache', 'latency', 'throughput', 'network', 'packet', 'socket', 'protocol',
+        'transaction', 'isolation', 'commit', 'rollback', 'schema', 'migration', 'iterator', 'generator', 'closure',
+        'decorator', 'exception', 'inheritance', 'interface', 'complexity', 'recursion', 'stack', 'heap', 'queue')
+    parts = []
+    size = 0
+    while size < target_bytes:
+        kind = rng.random()
+        if kind < 0.15:
+            part = '## ' + ' '.join(rng.choice(words) for _ in range(4)).title()
+        elif kind < 0.55:
+            part = ' '.join(rng.choice(words) if rng.random() < 0.9 else str(rng.randint(0, 10 ** 6)) for _ in range(rng.randint(20, 60))).capitalize() + '.'
+        elif kind < 0.75:
+            part = '\n'.join(f"- **{rng.choice(words)}**: " + ' '.join(rng.choice(words) for _ in range(8)) for _ in range(rng.randint(2, 6)))
+        else:
+            lines = [f"def {rng.choice(words)}_{rng.choice(words)}(items):"]
+            lines += [f"    {rng.choice(words)} = [x for x in items if x.{rng.choice(words)}]" for _ in range(rng.randint(2, 8))]
+            part = "```python\n" + '\n'.join(lines) + "\n    return items\n```"
+        parts.append(part)
+        size += len(part) + 2
+    return '\n\n'.join(parts)
+
+def stored_item_size(item):
+    # DynamoDB item size: attribute names plus values, numbers roughly one byte per two digits
+    size = 0
+    for name, value in item.items():
+        size += len(name)
+        if isinstance(value, str):
+            size += utf8_length(value)
+        elif isinstance(value, (bytes, bytearray)):
+            size += len(value)
+        else:
+            size += len(str(value)) // 2 + 1
+    return size
+
+def benchmark_answer_codec(cards, seed):
+    rng = random.Random(seed)
+    # Mostly short and medium answers, a tail close to the 8192 token output limit
+    sizes = [int(rng.choice((300, 800, 1500, 3000, 6000, 12000, 30000)) * rng.uniform(0.7, 1.3)) for _ in range(cards)]
+    answers = [sample_answer(rng, size) for size in sizes]
+    raw_items = [store.card_item('benchmark', f"Question {i}?", answer, 361393366870240 + i) for i, answer in enumerate(answers)]
+    started = time.process_time()
+    # Nothing in this sample reaches the S3 offload threshold, so this stays offline
+    stored_items = [store.stored_card_item('benchmark', item['question'], item['answer'], item['id']) for item in raw_items]
+    encode_s = time.process_time() - started
+    started = time.process_time()
+    decoded = [store.decode_card(dict(item)) for item in stored_items]
+    decode_s = time.process_time() - started
+    assert [item['answer'] for item in decoded] == answers
+
+    raw_bytes = sum(stored_item_size(item) for item in raw_items)
+    stored_bytes = sum(stored_item_size(item) for item in stored_items)
+    compressed = sum(1 for item in stored_items if 'answer_codec' in item)
+    # Eventually consistent query of the whole set, half a unit per started 4 KB
+    raw_rcu = math.ceil(raw_bytes / 4096) / 2
+    stored_rcu = math.ceil(stored_bytes / 4096) / 2
+    print(f"cards          {cards} ({compressed} compressed with {compress_answer(b'')[0]})")
+    print(f"item bytes     {raw_bytes} -> {stored_bytes} ({stored_bytes / raw_bytes:.1%})")
+    print(f"set query RCU  {raw_rcu:g} -> {stored_rcu:g}")
+    print(f"encode         {encode_s * 1e6 / cards:.1f} us/card")
+    print(f"decode         {decode_s * 1e6 / cards:.1f} us/card")
+
 def __main__():
+    parser = argparse.ArgumentParser(description="Flashcards backend")
+    subcommands = parser.add_subparsers(dest='subcommand')
+    serve_parser = subcommands.add_parser('serve', help="run a local HTTP server")
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    importtime_parser = subcommands.add_parser('importtime', help="report where module import time goes")
+    importtime_parser.add_argument('--top', type=int, default=20)
+    importtime_parser.add_argument('--ai', action='store_true', help="include the imports of the first AI command")
+    subcommands.add_parser('backfill-sets', help="add card counts and sort keys to sets created before they existed")
+    backup_parser = subcommands.add_parser('backup', help="back up the flashcards and sets tables to S3")
+    backup_parser.add_argument('--segments', type=int, default=BACKUP_SEGMENTS)
+    restore_parser = subcommands.add_parser('restore', help="restore the tables from a backup in S3")
+    restore_parser.add_argument('backup_id')
+    restore_parser.add_argument('--workers', type=int, default=BACKUP_MAX_WORKERS)
+    codec_parser = subcommands.add_parser('benchmark-answer-codec', help="measure storage and read units saved by answer compression")
+    codec_parser.add_argument('--cards', type=int, default=2000)
+    codec_parser.add_argument('--seed', type=int, default=1)
+    benchmark_parser = subcommands.add_parser('benchmark-deserialization', help="compare the resource and low-level DynamoDB item paths")
+    benchmark_parser.add_argument('--cards', type=int, default=10000)
+    benchmark_parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.subcommand == 'serve':
+        serve(args.host, args.port)
+        return
+    if args.subcommand == 'importtime':
+        import_time_report(args.top, args.ai)
+        return
+    if args.subcommand in ('backfill-sets', 'backup', 'restore'):
+        global _deadline
+        # No request timeout when run by hand
+        _deadline = Deadline(CLI_DEADLINE_MS)
+        if args.subcommand == 'backfill-sets':
+            print(f"Backfilled {store.backfill_set_aggregates()} sets")
+            return
+        if args.subcommand == 'backup':
+            result = run_backup(new_backup_id(), args.segments)
+        else:
+            result = run_restore(args.backup_id, args.workers)
+        print(json.dumps(result, indent=2, default=json_default))
+        return
+    if args.subcommand == 'benchmark-answer-codec':
+        benchmark_answer_codec(args.cards, args.seed)
+        return
+    if args.subcommand == 'benchmark-deserialization':
+        benchmark_deserialization(args.cards, args.repeats)
+        return
     response = suggest_flashcard_answer("What is the capital of France?")
     print(response)
 
@@ -4,4 +4,5 @@
 #curl -X POST http://helvetia-ai-alb-1572264382.eu-central-1.elb.amazonaws.com/flashcards -d '{"command": "add_flashcard","content": {"set_name": "kkk", "question": "What is the capital of France2?", "answer": "Paris2"}}' -v
 #curl -X POST http://helvetia-ai-alb-1572264382.eu-central-1.elb.amazonaws.com/flashcards -d '{"command": "get_flashcards","content": {"set_name": "kkk"}}' -v
 #curl -X POST http://helvetia-ai-alb-1572264382.eu-central-1.elb.amazonaws.com/flashcards -d '{"command": "suggest_flashcard_answer","content": {"question": "What is the capital of France?"}}' -v
+#curl -X POST http://helvetia-ai-alb-1572264382.eu-central-1.elb.amazonaws.com/flashcards -d '{"command": "batch","content": {"commands": [{"command": "get_sets"}, {"command": "get_flashcards", "content": {"set_name": "kkk"}}]}}' -v
 curl -X POST http://helvetia-ai-alb-1572264382.eu-central-1.elb.amazonaws.com/flashcards -d '{"command": "create_set","content": {"name": "test13", "description": "Flashcards created from uploaded file", "filename": "upload_20250225_111209.txt"}}' -v
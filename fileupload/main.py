@@ -4,11 +4,43 @@ from botocore.exceptions import ClientError
 import base64
 from datetime import datetime
 import os
+import logging
+import sys
 
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_FIELD_CHARS = int(os.environ.get('LOG_MAX_FIELD_CHARS', '500'))
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'level': record.levelname, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class Truncated:
+    # Renders a log argument only when the line is actually emitted, and caps its size
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit or LOG_MAX_FIELD_CHARS
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, default=str)
+        if len(text) > self.limit:
+            return f"{text[:self.limit]}... [{len(text)} chars]"
+        return text
+
+logger = logging.getLogger('flashcards-fileupload')
+logger.propagate = False
+if not logger.handlers:
+    _log_handler = logging.StreamHandler(sys.stdout)
+    _log_handler.setFormatter(JsonLogFormatter())
+    logger.addHandler(_log_handler)
+logger.setLevel(LOG_LEVEL)
 
 
 def lambda_handler(event, context):
-    print(f"File upload event received. Body present: {event['body'] is not None}")
+    logger.info("File upload event received. Body present: %s", event['body'] is not None)
+    logger.debug("headers: %s", Truncated(event.get('headers')))
     body = base64.b64decode(event['body'])
     # Parse the multipart form data to extract file content
     try:
@@ -62,7 +94,7 @@ def lambda_handler(event, context):
             Body=file_content
         )
         
-        print(f"File {filename} uploaded successfully")
+        logger.info("File %s uploaded successfully (%d bytes)", filename, len(file_content))
         return {
             'statusCode': 200,
             'headers': {
@@ -79,7 +111,7 @@ def lambda_handler(event, context):
             })
         }
     except Exception as e:
-        print(f"Error processing upload: {str(e)}")
+        logger.exception("Error processing upload: %s", e)
         return {
             'statusCode': 400,
             'headers': {